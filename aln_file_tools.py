@@ -3,24 +3,779 @@
 import re
 import sys
 import os
-import copy
+import collections
+import tempfile
+import mmap
+import json
+import hashlib
+import gzip
+import io
+import zlib
+import threading
+import concurrent.futures
+from queue import Queue
+import numpy as np
 import seq_tools
 
 """Functions for parsing and manipulating sequence alignment files
 Functions by Zach Zbinden and Tyler Chafin"""
 
-#Function to remove samples from a popmap dict, given a list of valid samples (e.g. those to retain)
-def cleanPopmap(popmap, names):
-	ret = copy.deepcopy(popmap)
-	to_remove = list()
-	for ind in popmap:
-		if ind not in names:
-			to_remove.append(ind)
-	for rem in sorted(to_remove, reverse=True):
-		del ret[rem]
+#Patterns used to step over whitespace when indexing memory-mapped files
+_SPACE = re.compile(rb"\s*")
+_SPACE_REQUIRED = re.compile(rb"\s+")
+
+#Object holding an alignment as a contiguous samples x sites uint8 matrix
+#Each row is one sample, stored as uppercase ASCII bytes
+#names = sample names in row order
+#index = dict of sample name -> row
+#skipped = [records, sequence bytes] of samples skipped by the reader (see readPhylip)
+#cache = (cache file, True if this load wrote it) when loaded through loadCached, else None
+#Also behaves like the old dict of sequences (iterating gives names, aln[name] gives a string)
+class Alignment():
+	def __init__(self, names, matrix):
+		self.names = list(names)
+		self.matrix = matrix
+		self.index = dict()
+		for i, name in enumerate(self.names):
+			self.index[name] = i
+		self.skipped = [0, 0]
+		self.cache = None
+		self.tmpPath = None #temporary backing file to remove on close (see memmapAlignment)
+
+	#A memory-mapped matrix is pickled as its file location rather than its contents, so
+	#worker processes re-map the same file instead of receiving a copy
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		if isinstance(self.matrix, np.memmap) and self.matrix.filename:
+			state["matrix"] = None
+			state["_memmap"] = (self.matrix.filename, self.matrix.offset, self.matrix.shape)
+		state["tmpPath"] = None
+		return(state)
+
+	def __setstate__(self, state):
+		mapped = state.pop("_memmap", None)
+		self.__dict__.update(state)
+		if mapped is not None:
+			filename, offset, shape = mapped
+			self.matrix = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset, shape=shape)
+
+	def __len__(self):
+		return(len(self.names))
+
+	def __iter__(self):
+		return(iter(self.names))
+
+	def __contains__(self, name):
+		return(name in self.index)
+
+	def __getitem__(self, name):
+		return(self.matrix[self.index[name]].tobytes().decode())
+
+	def keys(self):
+		return(list(self.names))
+
+	#Returns number of sites (columns)
+	def getSeqLen(self):
+		return(self.matrix.shape[1])
+
+	#Returns row r (or the row of a sample name) as a uint8 array (a view, not a copy)
+	def sequence(self, r):
+		if not isinstance(r, (int, np.integer)):
+			r = self.index[r]
+		return(self.matrix[r])
+
+	#Returns a (rows x (end-start)) uint8 matrix for columns [start, end)
+	#Same interface as ColumnReader.readBlock
+	def readBlock(self, start, end, rows=None):
+		if rows is None:
+			return(np.array(self.matrix[:,start:end]))
+		else:
+			return(self.matrix[rows,start:end])
+
+	def close(self):
+		self.matrix = None
+		if self.tmpPath is not None and os.path.exists(self.tmpPath):
+			os.remove(self.tmpPath)
+		self.tmpPath = None
+
+	#Returns a new object of the same kind, holding matrix in place of this one's
+	def _like(self, names, matrix):
+		return(Alignment(names, matrix))
+
+#Alignment holding 4-bit nucleotide masks (see seq_tools.nucMasks) packed two sites per
+#byte (see seq_tools.packMasks), in half the memory of an Alignment
+#matrix = samples x ceil(nsites/2) packed bytes; nsites = number of sites
+#readMasks unpacks only the requested block; readBlock and the sequence accessors return
+#uppercase characters (lowercase codes read as uppercase; packAlignment raises ValueError on any
+#character that is not an IUPAC code, N or gap, such as "?")
+class PackedAlignment(Alignment):
+	def __init__(self, names, packed, nsites):
+		Alignment.__init__(self, names, packed)
+		self.nsites = nsites
+
+	def __getitem__(self, name):
+		return(self.sequence(name).tobytes().decode())
+
+	def getSeqLen(self):
+		return(self.nsites)
+
+	#Returns row r (or the row of a sample name) as a uint8 array of characters (a copy)
+	def sequence(self, r):
+		if not isinstance(r, (int, np.integer)):
+			r = self.index[r]
+		return(self.readBlock(0, self.nsites, [r])[0])
+
+	#Returns a (rows x (end-start)) matrix of masks for columns [start, end)
+	def readMasks(self, start, end, rows=None):
+		cols = slice(start // 2, (end + 1) // 2)
+		packed = self.matrix[:,cols] if rows is None else self.matrix[rows,cols]
+		return(seq_tools.unpackMasks(packed, start % 2, end-start))
+
+	def readBlock(self, start, end, rows=None):
+		return(seq_tools.MASK_CHARS[self.readMasks(start, end, rows)])
+
+	def _like(self, names, matrix):
+		return(PackedAlignment(names, matrix, self.nsites))
+
+#Function to pack an alignment (Alignment or ColumnReader), reading block columns at a time
+#so that the unpacked matrix is never held in memory (unless it already is)
+#Returns a PackedAlignment; raises ValueError for invalid characters
+def packAlignment(seqs, block=65536):
+	if isinstance(seqs, PackedAlignment):
+		return(seqs)
+	nsites = seqs.getSeqLen()
+	block += block % 2
+	packed = np.empty((len(seqs.names), (nsites + 1) // 2), dtype=np.uint8)
+	for start in range(0, nsites, block):
+		end = min(start+block, nsites)
+		packed[:,start//2:(end+1)//2] = seq_tools.packMasks(seq_tools.nucMasks(seqs.readBlock(start, end)))
+	ret = PackedAlignment(seqs.names, packed, nsites)
+	ret.skipped = list(seqs.skipped)
+	ret.cache = getattr(seqs, "cache", None)
+	return(ret)
+
+#Function to move an in-memory Alignment into a memory-mapped temporary file, so that it
+#can be shared with worker processes without copying. The file is removed on close()
+def memmapAlignment(seqs, tmpdir=None):
+	if isinstance(seqs.matrix, np.memmap) or seqs.matrix.size == 0:
+		return(seqs)
+	fd, path = tempfile.mkstemp(suffix=".matrix", dir=tmpdir)
+	with os.fdopen(fd, "wb") as fh:
+		fh.write(np.ascontiguousarray(seqs.matrix).tobytes())
+	ret = seqs._like(seqs.names, np.memmap(path, dtype=np.uint8, mode="r", shape=seqs.matrix.shape))
+	ret.tmpPath = path
+	return(ret)
+
+#Function to build an Alignment from a list of names and a list of sequences (str or bytes)
+def buildAlignment(names, seqs):
+	if not names:
+		return(Alignment(list(), np.empty((0,0), dtype=np.uint8)))
+	alen = len(seqs[0])
+	mat = np.empty((len(names), alen), dtype=np.uint8)
+	for i, s in enumerate(seqs):
+		if len(s) != alen:
+			raise ValueError("Sequence %s has length %s (expected %s). Alignment contains sequences of multiple lengths."%(names[i], len(s), alen))
+		if isinstance(s, str):
+			s = s.encode()
+		mat[i] = np.frombuffer(s.upper(), dtype=np.uint8)
+	return(Alignment(names, mat))
+
+#Function to group row numbers by population, given a dict of sample name -> row
+#Only retains samples assigned to one of pops; rows within each pop follow popmap order
+#Returns dict of population -> array of rows
+def groupRows(index, popmap, pops):
+	groups = collections.OrderedDict()
+	for pop in pops:
+		groups[pop] = list()
+	for ind, pop in popmap.items():
+		if pop in groups and ind in index:
+			groups[pop].append(index[ind])
+	ret = collections.OrderedDict()
+	for pop, rows in groups.items():
+		ret[pop] = np.array(rows, dtype=np.intp)
+	return(ret)
+
+#Object for reading blocks of columns from a sequential PHYLIP or (fixed line width) FASTA
+#file without loading whole sequences into memory
+#The file is memory-mapped and indexed once to find where each sequence starts and its
+#line geometry; sequences are then read straight out of the mapping
+#For PHYLIP, indexing jumps from row to row using nchar from the header, so only the pages
+#holding row starts are touched, and sequence() gives a zero-copy view of a row
+#keep = set of sample names to index (default all); others are skipped, and counted in
+#skipped = [records, sequence bytes]
+class ColumnReader():
+	def __init__(self, path, fmt="phylip", keep=None):
+		if not os.path.exists(path):
+			raise FileNotFoundError("File %s not found!"%path)
+		if compression(path) is not None:
+			raise ValueError("Compressed file %s can't be memory-mapped; use readPhylip/readFastaAlign."%path)
+		self.path = path
+		self.names = list()
+		self.index = dict()
+		self.offsets = list() #byte offset of the first base of each sequence
+		self.lineBases = list() #bases per line
+		self.lineBytes = list() #bytes per line, including newline
+		self.nsites = None
+		self.keep = keep
+		self.skipped = [0, 0]
+		self._open()
+		if fmt == "phylip":
+			self._indexPhylip()
+		elif fmt == "fasta":
+			self._indexFasta()
+		else:
+			raise ValueError("Unknown alignment format %s"%fmt)
+		for i, name in enumerate(self.names):
+			self.index[name] = i
+
+	def _open(self):
+		self.fh = open(self.path, "rb")
+		if os.path.getsize(self.path) > 0:
+			self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+			self.buffer = np.frombuffer(self.mm, dtype=np.uint8)
+		else:
+			self.mm = None
+			self.buffer = np.empty(0, dtype=np.uint8)
+
+	#Pickled as its index only; the file is re-mapped when unpickled (e.g. in a worker process)
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for key in ("fh", "mm", "buffer"):
+			state[key] = None
+		return(state)
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._open()
+
+	def __len__(self):
+		return(len(self.names))
+
+	def __contains__(self, name):
+		return(name in self.index)
+
+	#Returns number of sites (columns)
+	def getSeqLen(self):
+		return(self.nsites)
+
+	def _addRecord(self, name, offset, length, lineBases, lineBytes):
+		if self.nsites is None:
+			self.nsites = length
+		elif length != self.nsites:
+			raise ValueError("Sequence %s has length %s (expected %s). Alignment contains sequences of multiple lengths."%(name, length, self.nsites))
+		if self.keep is not None and name not in self.keep:
+			self.skipped[0] += 1
+			self.skipped[1] += ((length-1) // lineBases)*lineBytes + (length-1) % lineBases + 1 if length else 0
+			return
+		self.names.append(name)
+		self.offsets.append(offset)
+		self.lineBases.append(lineBases)
+		self.lineBytes.append(lineBytes)
+
+	def _indexPhylip(self):
+		mm = self.mm
+		if mm is None:
+			return
+		#parse header for ntax and nchar
+		pos = _SPACE.match(mm, 0).end()
+		end = mm.find(b"\n", pos)
+		if end < 0:
+			end = len(mm)
+		ntax, nchar = [int(x) for x in mm[pos:end].split()[0:2]]
+		pos = end
+		for num in range(ntax):
+			pos = _SPACE.match(mm, pos).end()
+			if pos >= len(mm):
+				raise ValueError("PHYLIP file %s contains %s sequences (expected %s)."%(self.path, num, ntax))
+			found = _SPACE_REQUIRED.search(mm, pos)
+			if not found:
+				raise ValueError("Could not find sequence after name on row %s of %s."%(num+1, self.path))
+			name = mm[pos:found.start()].decode()
+			seqStart = found.end()
+			pos = seqStart + nchar
+			#row must end after nchar characters (this check does not read the sequence itself)
+			if pos > len(mm) or (pos < len(mm) and not mm[pos:pos+1].isspace()):
+				raise ValueError("Sequence %s does not have length %s. Input must be sequential (non-interleaved) PHYLIP."%(name, nchar))
+			self._addRecord(name, seqStart, nchar, nchar, nchar+1)
+		if self.nsites is None:
+			self.nsites = nchar
 
+	#FASTA records are indexed from a .fai file next to the input (as written by samtools
+	#faidx, or by this method) if it is newer than the input and matches it (see _checkFai);
+	#otherwise the file is scanned for headers and line breaks with NumPy, and the .fai is
+	#(re)written if possible
+	def _indexFasta(self):
+		records = readFai(self.path)
+		if records is not None:
+			records = self._checkFai(records)
+		if records is None:
+			records = self._scanFasta()
+			try:
+				writeFai(self.path, records)
+			except OSError:
+				pass
+		for record in records:
+			self._addRecord(*record)
+
+	#Function checks .fai records against the file: each must start right after a header line
+	#and end at a line break, with nothing but blank lines between records (so none are
+	#missing). Names are taken from the headers, as in _scanFasta, so a samtools index (which
+	#names records by the first word of the header) gives the same names as a scan
+	#Returns the records (without empty ones), or None if the index does not match the file
+	def _checkFai(self, records):
+		mm = self.mm
+		if mm is None:
+			return(None)
+		ret = list()
+		prevEnd = 0
+		for name, offset, length, lineBases, lineBytes in records:
+			if offset < 1 or offset > len(mm) or length < 0 or lineBases < 1 or lineBytes < lineBases:
+				return(None)
+			h = mm.rfind(b"\n", 0, offset-1) + 1
+			if mm[offset-1:offset] != b"\n" or mm[h:h+1] != b">" or h < prevEnd or mm[prevEnd:h].strip():
+				return(None)
+			header = mm[h:offset].rstrip(b"\r\n").decode()
+			full = header.replace(" ","").replace(">","")
+			words = header[1:].split()
+			if name != full and (not words or name != words[0]):
+				return(None)
+			end = offset + ((length-1)//lineBases)*lineBytes + (length-1)%lineBases + 1 if length else offset
+			if end > len(mm) or mm[end:end+1] not in (b"", b"\n", b"\r"):
+				return(None)
+			prevEnd = end
+			if length:
+				ret.append((full, offset, length, lineBases, lineBytes))
+		if mm[prevEnd:].strip():
+			return(None)
+		return(ret)
+
+	#Returns list of (name, offset, length, lineBases, lineBytes) for every record
+	#Names are the header line without ">" or spaces (as readFastaAlign)
+	#Raises ValueError if a sequence does not have a constant line width
+	def _scanFasta(self, chunk=1 << 26):
+		buf = self.buffer
+		headers = list()
+		for start in range(0, len(buf), chunk):
+			found = np.flatnonzero(buf[start:start+chunk] == ord(">")) + start
+			headers.extend(found[(found == 0) | (buf[np.maximum(found-1, 0)] == ord("\n"))].tolist())
+		records = list()
+		for h, end in zip(headers, headers[1:] + [len(buf)]):
+			nameEnd = self.mm.find(b"\n", h, end)
+			seqStart = end if nameEnd < 0 else nameEnd + 1
+			name = self.mm[h:seqStart].rstrip(b"\r\n").replace(b" ",b"").replace(b">",b"").decode()
+			region = buf[seqStart:end]
+			breaks = np.flatnonzero(region == ord("\n"))
+			starts = np.concatenate(([0], breaks + 1))
+			ends = np.concatenate((breaks, [len(region)]))
+			bases = ends - starts
+			bases[bases > 0] -= (region[ends[bases > 0] - 1] == ord("\r"))
+			#blank lines are only allowed after the sequence
+			lines = np.flatnonzero(bases > 0)
+			if len(lines) == 0:
+				continue
+			nlines = lines[-1] + 1
+			starts, bases = starts[0:nlines], bases[0:nlines]
+			lineBytes = int(starts[1] - starts[0]) if nlines > 1 else int(ends[0] - starts[0] + 1)
+			if (bases[0:-1] != bases[0]).any() or bases[-1] > bases[0] or (np.diff(starts) != lineBytes).any():
+				raise ValueError("Sequence %s in %s does not have a constant line width."%(name, self.path))
+			records.append((name, seqStart, int(bases.sum()), int(bases[0]), lineBytes))
+		return(records)
+
+	#Returns file position of base i of row r
+	def _position(self, r, i):
+		return(self.offsets[r] + (i // self.lineBases[r])*self.lineBytes[r] + (i % self.lineBases[r]))
+
+	#Returns the sequence of row r (or of a sample name) as a uint8 array of characters as
+	#stored in the file. This is a zero-copy view into the mapping when the sequence is on
+	#one line (always true for PHYLIP)
+	def sequence(self, r):
+		if not isinstance(r, (int, np.integer)):
+			r = self.index[r]
+		if self.lineBases[r] >= self.nsites:
+			return(self.buffer[self.offsets[r]:self.offsets[r]+self.nsites])
+		else:
+			return(self.readBlock(0, self.nsites, [r])[0])
+
+	#Returns a (rows x (end-start)) uint8 matrix of characters (as stored in the file) for
+	#columns [start, end)
+	def readBlock(self, start, end, rows=None):
+		if rows is None:
+			rows = range(len(self.names))
+		ret = np.empty((len(rows), end-start), dtype=np.uint8)
+		if end <= start:
+			return(ret)
+		for k, r in enumerate(rows):
+			first = self._position(r, start)
+			last = self._position(r, end-1) + 1
+			if self.lineBases[r] >= self.nsites:
+				ret[k] = self.buffer[first:last]
+			else:
+				raw = self.mm[first:last].replace(b"\n", b"").replace(b"\r", b"")
+				ret[k] = np.frombuffer(raw, dtype=np.uint8)
+		return(ret)
+
+	#Returns the bases [start, end) of a sample (default its whole sequence) as a string,
+	#read straight from the file (like samtools faidx name:start-end, but 0-based)
+	def fetch(self, name, start=0, end=None):
+		if end is None or end > self.nsites:
+			end = self.nsites
+		return(self.readBlock(start, end, [self.index[name]])[0].tobytes().decode())
+
+	def close(self):
+		self.buffer = None
+		if self.mm is not None:
+			try:
+				self.mm.close()
+			except BufferError:
+				#views returned by sequence() are still alive; mapping is freed with them
+				pass
+		self.fh.close()
+
+#Function returns the records of the .fai index of a FASTA file, as a list of (name, offset,
+#length, lineBases, lineBytes), or None if there is no index or it is older than the file
+def readFai(fas):
+	fai = fas + ".fai"
+	if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fas):
+		return(None)
+	records = list()
+	with open(fai, "r") as fh:
+		for line in fh:
+			fields = line.rstrip("\r\n").split("\t")
+			if len(fields) < 5:
+				return(None)
+			records.append((fields[0], int(fields[2]), int(fields[1]), int(fields[3]), int(fields[4])))
+	return(records)
+
+#Function writes a .fai index (NAME, LENGTH, OFFSET, LINEBASES, LINEWIDTH; as samtools faidx)
+#for records of (name, offset, length, lineBases, lineBytes)
+def writeFai(fas, records):
+	with open(fas + ".fai", "w") as fh:
+		for name, offset, length, lineBases, lineBytes in records:
+			fh.write("%s\t%s\t%s\t%s\t%s\n"%(name, length, offset, lineBases, lineBytes))
+
+#Binary alignment cache, so repeated runs skip parsing the text alignment
+#Layout: magic, 8-byte header length, JSON header (names, shape, and the input's path,
+#size, mtime and content hash), then the samples x sites uint8 matrix (row-major)
+CACHE_MAGIC = b"SBMCACHE1"
+CACHE_SUFFIX = ".sbmcache"
+
+#Function returns the cache file path for an alignment (next to it, or in cacheDir)
+def cachePath(path, cacheDir=None):
+	path = os.path.abspath(path)
+	if cacheDir is None:
+		return(path + CACHE_SUFFIX)
+	key = hashlib.blake2b(path.encode(), digest_size=6).hexdigest()
+	return(os.path.join(cacheDir, os.path.basename(path) + "." + key + CACHE_SUFFIX))
+
+#Function returns a hex digest of a file's contents
+def fileHash(path):
+	digest = hashlib.blake2b(digest_size=16)
+	with open(path, "rb") as fh:
+		for chunk in iter(lambda: fh.read(1 << 24), b""):
+			digest.update(chunk)
+	return(digest.hexdigest())
+
+#Function to read the JSON header of a cache (or summary) file. Returns (header, data offset)
+def _readCacheHeader(cache, magic=CACHE_MAGIC, kind="an alignment cache"):
+	with open(cache, "rb") as fh:
+		if fh.read(len(magic)) != magic:
+			raise ValueError("%s is not %s file."%(cache, kind))
+		hlen = int.from_bytes(fh.read(8), "little")
+		header = json.loads(fh.read(hlen).decode())
+	return(header, len(magic) + 8 + hlen)
+
+#Function to encode a cache header as JSON, padded with spaces to hlen bytes
+#By default leaves some slack and pads so the matrix starts on a 4096-byte boundary,
+#so the header can later be rewritten in place
+def _packCacheHeader(header, hlen=None, magic=CACHE_MAGIC):
+	hbytes = json.dumps(header).encode()
+	if hlen is None:
+		start = len(magic) + 8
+		hlen = ((start + len(hbytes) + 256 + 4095) // 4096)*4096 - start
+	if len(hbytes) > hlen:
+		return(None)
+	return(hbytes.ljust(hlen))
+
+#Function to write an alignment (Alignment or ColumnReader) to a cache file, one row at a time
+#The file is written under a temporary name and moved into place when complete
+def writeCache(cache, path, seqs):
+	stat = os.stat(path)
+	header = dict()
+	header["path"] = os.path.abspath(path)
+	header["size"] = stat.st_size
+	header["mtime"] = stat.st_mtime_ns
+	header["hash"] = fileHash(path)
+	header["shape"] = [len(seqs.names), seqs.getSeqLen()]
+	header["names"] = list(seqs.names)
+	hbytes = _packCacheHeader(header)
+	tmp = cache + ".tmp" + str(os.getpid())
+	with open(tmp, "wb") as fh:
+		fh.write(CACHE_MAGIC)
+		fh.write(len(hbytes).to_bytes(8, "little"))
+		fh.write(hbytes)
+		for r in range(len(seqs.names)):
+			fh.write(np.ascontiguousarray(seqs.sequence(r)).tobytes())
+	os.replace(tmp, cache)
+
+#Function to load a cache file for an alignment, as an Alignment backed by a memory map
+#Returns None if there is no cache, or if the input has changed since it was written
+#(the content hash is only recomputed when the size or mtime no longer match)
+def readCache(cache, path):
+	if not os.path.exists(cache):
+		return(None)
+	try:
+		header, offset = _readCacheHeader(cache)
+	except ValueError:
+		return(None)
+	stat = os.stat(path)
+	if header["path"] != os.path.abspath(path) or header["size"] != stat.st_size:
+		return(None)
+	if header["mtime"] != stat.st_mtime_ns:
+		if header["hash"] != fileHash(path):
+			return(None)
+		#contents unchanged (e.g. file was touched): record new mtime so we don't re-hash
+		header["mtime"] = stat.st_mtime_ns
+		hbytes = _packCacheHeader(header, offset - len(CACHE_MAGIC) - 8)
+		if hbytes is not None:
+			try:
+				with open(cache, "r+b") as fh:
+					fh.seek(len(CACHE_MAGIC) + 8)
+					fh.write(hbytes)
+			except IOError:
+				pass
+	nsamples, nsites = header["shape"]
+	if nsamples*nsites == 0:
+		mat = np.empty((nsamples, nsites), dtype=np.uint8)
+	else:
+		mat = np.memmap(cache, dtype=np.uint8, mode="r", offset=offset, shape=(nsamples, nsites))
+	return(Alignment(header["names"], mat))
+
+#Function to load an alignment through the cache: loads the cache if it is up to date,
+#otherwise parses the input, (re)writes the cache, and loads that
+#fmt = "phylip" or "fasta". The cache attribute of the returned Alignment tells which happened
+def loadCached(path, fmt, cacheDir=None):
+	if not os.path.exists(path):
+		raise FileNotFoundError("File %s not found!"%path)
+	cache = cachePath(path, cacheDir)
+	ret = readCache(cache, path)
+	if ret is not None:
+		ret.cache = (cache, False)
+		return(ret)
+	if compression(path) is not None:
+		#compressed input can't be indexed, so it is decompressed and loaded once
+		if fmt == "phylip":
+			seqs = readPhylip(path)
+		else:
+			seqs = readFastaAlign(path)
+	elif fmt == "phylip":
+		seqs = ColumnReader(path, "phylip")
+	else:
+		try:
+			seqs = ColumnReader(path, "fasta")
+		except ValueError:
+			seqs = readFastaAlign(path)
+	if cacheDir is not None and not os.path.exists(cacheDir):
+		os.makedirs(cacheDir)
+	writeCache(cache, path, seqs)
+	seqs.close()
+	ret = readCache(cache, path)
+	ret.cache = (cache, True)
 	return(ret)
 
+#Per-population allele count summary: everything the filters and the sampler need, without
+#the per-sample data. Layout: magic, 8-byte header length, JSON header (pops, pop sizes,
+#number of sites stored, number of input sites/records read, count dtype), then the
+#(sites x pops*6) allele counts (A, C, G, T, N, gap; row-major), then the int64 input index
+#of each stored site (which keys the random numbers used for sampling)
+SUMMARY_MAGIC = b"SBMCOUNTS1"
+
+#Object writing a count summary one block of sites at a time
+#The counts are written as they come; site indices go to a temporary BlockStore and are
+#copied to the end of the file (and the header completed) by close()
+class SummaryWriter():
+	def __init__(self, path, pops, sizes, dtype=np.uint16):
+		self.path = path
+		self.header = collections.OrderedDict()
+		self.header["pops"] = list(pops)
+		self.header["sizes"] = [int(size) for size in sizes]
+		self.header["dtype"] = np.dtype(dtype).name
+		self.header["nsites"] = 0
+		self.header["input_sites"] = 0
+		self.header["input_snps"] = None
+		self.dtype = np.dtype(dtype)
+		self.sites = BlockStore(1, dtype=np.int64)
+		self.tmp = path + ".tmp" + str(os.getpid())
+		self.hbytes = _packCacheHeader(self.header, None, SUMMARY_MAGIC)
+		self.fh = open(self.tmp, "wb")
+		self.fh.write(SUMMARY_MAGIC)
+		self.fh.write(len(self.hbytes).to_bytes(8, "little"))
+		self.fh.write(self.hbytes)
+
+	#Appends (pops x 6 x sites) counts for the given site indices
+	def append(self, counts, sites):
+		self.fh.write(np.ascontiguousarray(counts.reshape(-1, counts.shape[-1]).T, dtype=self.dtype).tobytes())
+		self.sites.append(np.asarray(sites, dtype=np.int64).reshape(1, -1))
+
+	#Completes the file and moves it into place
+	#inputSites = sites (or VCF records) read from the input; inputSnps = biallelic SNP records
+	def close(self, inputSites, inputSnps=None):
+		for block in self.sites.iterBlocks():
+			self.fh.write(block.tobytes())
+		self.header["nsites"] = self.sites.getSeqLen()
+		self.header["input_sites"] = int(inputSites)
+		self.header["input_snps"] = None if inputSnps is None else int(inputSnps)
+		self.sites.close()
+		self.fh.seek(len(SUMMARY_MAGIC) + 8)
+		self.fh.write(_packCacheHeader(self.header, len(self.hbytes), SUMMARY_MAGIC))
+		self.fh.close()
+		os.replace(self.tmp, self.path)
+
+	#Removes an incomplete file
+	def abort(self):
+		self.sites.close()
+		self.fh.close()
+		if os.path.exists(self.tmp):
+			os.remove(self.tmp)
+
+#Object reading a count summary (memory-mapped), as input in place of an alignment
+#pops = population names; sizes = samples per population
+#popIndex = dict of pop -> "rows": the slots its samples had, so that sizes can be taken
+#from popIndex as for an alignment (there is no per-sample data)
+class CountSummary():
+	def __init__(self, path):
+		if not os.path.exists(path):
+			raise FileNotFoundError("File %s not found!"%path)
+		header, offset = _readCacheHeader(path, SUMMARY_MAGIC, "a count summary")
+		self.path = path
+		self.pops = list(header["pops"])
+		self.sizes = list(header["sizes"])
+		self.nsites = header["nsites"]
+		self.inputSites = header["input_sites"]
+		self.inputSnps = header["input_snps"]
+		self.dtype = np.dtype(header["dtype"])
+		self.popIndex = collections.OrderedDict()
+		start = 0
+		for pop, size in zip(self.pops, self.sizes):
+			self.popIndex[pop] = np.arange(start, start+size, dtype=np.intp)
+			start += size
+		self.index = dict((pop, k) for k, pop in enumerate(self.pops))
+		width = len(self.pops)*6
+		if self.nsites == 0:
+			self.counts = np.empty((0, width), dtype=self.dtype)
+			self.sites = np.empty(0, dtype=np.int64)
+		else:
+			self.counts = np.memmap(path, dtype=self.dtype, mode="r", offset=offset, shape=(self.nsites, width))
+			self.sites = np.memmap(path, dtype=np.int64, mode="r", offset=offset + self.counts.nbytes, shape=(self.nsites,))
+
+	def __len__(self):
+		return(sum(self.sizes))
+
+	def __contains__(self, pop):
+		return(pop in self.index)
+
+	#Returns number of sites stored
+	def getSeqLen(self):
+		return(self.nsites)
+
+	#Returns ((pops x 6 x sites) counts, site indices) for stored sites [start, end),
+	#optionally only for the pops numbered in pops
+	def readBlock(self, start, end, pops=None):
+		counts = np.array(self.counts[start:end]).T.reshape(len(self.pops), 6, end-start)
+		if pops is not None:
+			counts = counts[np.asarray(pops, dtype=np.intp)]
+		return(counts, np.array(self.sites[start:end]))
+
+	def close(self):
+		self.counts = None
+		self.sites = None
+
+#Object storing a (rows x sites) matrix as blocks of columns, e.g. so that the NEXUS header
+#can be written once the final number of sites is known
+#Blocks are appended to a temporary file, or kept in memory if inMemory=True
+#A file-backed store can be pickled (e.g. sent to worker processes) and read from there;
+#only the process that created it deletes the file on close()
+class BlockStore():
+	def __init__(self, nrows, tmpdir=None, inMemory=False, dtype=np.uint8):
+		self.nrows = nrows
+		self.dtype = np.dtype(dtype)
+		self.widths = list()
+		self.blocks = None
+		self.path = None
+		self.fh = None
+		self.owner = True
+		if inMemory:
+			self.blocks = list()
+		else:
+			fd, self.path = tempfile.mkstemp(suffix=".blocks", dir=tmpdir)
+			self.fh = os.fdopen(fd, "w+b")
+
+	def __getstate__(self):
+		if self.fh is not None:
+			self.fh.flush()
+		state = self.__dict__.copy()
+		state["fh"] = None
+		state["owner"] = False
+		return(state)
+
+	def _file(self):
+		if self.fh is None:
+			self.fh = open(self.path, "rb")
+		return(self.fh)
+
+	#Appends a (rows x sites) block
+	def append(self, block):
+		if block.shape[1] > 0:
+			if self.blocks is not None:
+				self.blocks.append(np.ascontiguousarray(block, dtype=self.dtype))
+			else:
+				self._file().write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+			self.widths.append(block.shape[1])
+
+	#Returns number of sites stored
+	def getSeqLen(self):
+		return(sum(self.widths))
+
+	#Generator yielding each stored block as a (rows x sites) array
+	def iterBlocks(self):
+		if self.blocks is not None:
+			for block in self.blocks:
+				yield(block)
+		else:
+			fh = self._file()
+			offset = 0
+			for width in self.widths:
+				fh.seek(offset)
+				nbytes = self.nrows*width*self.dtype.itemsize
+				yield(np.frombuffer(fh.read(nbytes), dtype=self.dtype).reshape(self.nrows, width))
+				offset += nbytes
+
+	#Generator yielding the pieces of row r from each block in turn (bytes, or a view of
+	#the block for an in-memory store; both can be written straight to a binary file)
+	def iterRow(self, r):
+		if self.blocks is not None:
+			for block in self.blocks:
+				yield(block[r])
+		else:
+			fh = self._file()
+			offset = 0
+			size = self.dtype.itemsize
+			for width in self.widths:
+				fh.seek(offset + r*width*size)
+				yield(fh.read(width*size))
+				offset += self.nrows*width*size
+
+	def close(self):
+		if self.fh is not None:
+			self.fh.close()
+			self.fh = None
+		if self.owner and self.path is not None and os.path.exists(self.path):
+			os.remove(self.path)
+		self.blocks = None
+
+#Function to remove samples from a popmap dict, given a list of valid samples (e.g. those to retain)
+def cleanPopmap(popmap, names):
+	return(collections.OrderedDict((ind, pop) for ind, pop in popmap.items() if ind in names))
+
 #function reads a tab-delimited popmap file and return dictionary of assignments
 def parsePopmap(popmap):
 	ret = dict()
@@ -45,40 +800,394 @@ def parsePopmap(popmap):
 	else:
 		raise FileNotFoundError("File %s not found!"%popmap)
 
+#Pattern matching the (1-based, inclusive) first and last column at the end of a locus line
+_LOCUS_RANGE = re.compile(r"(\d+)\s*(?:-|\s)\s*(\d+)\s*;?\s*$")
+
+#Function reads a locus boundary file, e.g. for a concatenated RAD alignment: one locus per
+#line, ending with its first and last column (1-based, inclusive), as in "1-85",
+#"locus1	1	85" or a partition file line "DNA, locus1 = 1-85". Lines starting with # are ignored
+#Returns (starts, ends) as 0-based, end-exclusive int64 arrays sorted by start
+#Raises ValueError for malformed or overlapping loci
+def parseLoci(loci):
+	if not os.path.exists(loci):
+		raise FileNotFoundError("File %s not found!"%loci)
+	ranges = list()
+	with open(loci, "r") as fh:
+		for number, line in enumerate(fh, 1):
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			match = _LOCUS_RANGE.search(line)
+			if match is None or int(match.group(1)) < 1 or int(match.group(2)) < int(match.group(1)):
+				raise ValueError("Line %s of locus file %s is not a valid column range: %s"%(number, loci, line))
+			ranges.append((int(match.group(1)) - 1, int(match.group(2))))
+	if not ranges:
+		raise ValueError("Locus file %s has no loci"%loci)
+	ranges.sort()
+	for (start, end), (nextStart, nextEnd) in zip(ranges, ranges[1:]):
+		if nextStart < end:
+			raise ValueError("Loci %s-%s and %s-%s in %s overlap"%(start+1, end, nextStart+1, nextEnd, loci))
+	ranges = np.array(ranges, dtype=np.int64).reshape(len(ranges), 2)
+	return(ranges[:,0], ranges[:,1])
+
+#Function reads a BED-like file of column ranges: "start end" or "name start end ...",
+#0-based and end-exclusive (as BED). Blank, "#", "track" and "browser" lines are ignored
+#Returns list of (start, end); raises ValueError for malformed lines
+def parseRegions(bed):
+	if not os.path.exists(bed):
+		raise FileNotFoundError("File %s not found!"%bed)
+	ret = list()
+	with open(bed, "r") as fh:
+		for number, line in enumerate(fh, 1):
+			fields = line.split()
+			if not fields or fields[0].startswith("#") or fields[0] in ("track", "browser"):
+				continue
+			try:
+				start, end = (int(x) for x in (fields[0:2] if len(fields) == 2 else fields[1:3]))
+			except ValueError:
+				raise ValueError("Line %s of region file %s is not a valid BED range: %s"%(number, bed, line.strip()))
+			if start < 0 or end <= start:
+				raise ValueError("Line %s of region file %s is not a valid BED range: %s"%(number, bed, line.strip()))
+			ret.append((start, end))
+	return(ret)
+
+#Function to open an output file for writing bytes, with a large write buffer
+#Output is gzip-compressed if the file name ends with .gz
+def openOutput(path, buffering=1 << 22):
+	if path.endswith(".gz"):
+		return(io.BufferedWriter(gzip.open(path, "wb", compresslevel=6), buffer_size=buffering))
+	else:
+		return(open(path, "wb", buffering=buffering))
+
+#Function returns the NEXUS data block header for a numeric (012) matrix
+def nexusHeader(ntax, nchar):
+	header = "#NEXUS\n\nBegin data;\nDimensions ntax=" + str(ntax) + " nchar=" + str(nchar) + ";\n"
+	header = header + "Format datatype=dna symbols=\"012\" missing=? gap=-;\nMatrix\n\n"
+	return(header)
+
+#Function returns the PHYLONET block with an MLE_BiMarkers skeleton command
+#assign = dict of output taxon -> population, in output order
+def phylonetBlock(assign):
+	popGroup = collections.OrderedDict()
+	for sampleID, popID in assign.items():
+		if popID not in popGroup:
+			popGroup[popID] = list()
+		popGroup[popID].append(sampleID)
+	taxalist = ",".join(assign)
+	taxamap = ";".join([popID + ":" + ",".join(members) for popID, members in popGroup.items()])
+	return("BEGIN PHYLONET;\nMLE_BiMarkers -taxa (" + taxalist + ") -tm <" + taxamap + ">;\nEND;\n")
+
+#Function returns a uint8 lookup table mapping every byte to itself, except those in changes
+def _byteTable(changes):
+	ret = np.arange(256, dtype=np.uint8)
+	for old, new in changes.items():
+		ret[ord(old)] = ord(new)
+	return(ret)
+
+#Output writers for an encoded (0, 1, ?, -) matrix, written by writeMatrix
+#Each writer gets the header information once (begin), then every row as a list of byte
+#strings (the blocks of a BlockStore row, shared by all writers), then end()
+class MatrixWriter():
+	#Default file name suffix, replacing the extension of the output name (see outputPaths)
+	suffix = ".txt"
+	#Whether the file is gzip-compressed when the output name ends in .gz
+	text = True
+
+	def __init__(self, path):
+		self.path = path
+		self.fh = openOutput(path) if self.text else open(path, "wb", buffering=1 << 22)
+
+	def begin(self, names, nchar, assign=None):
+		pass
+
+	def row(self, name, parts):
+		self.fh.write((str(name) + " ").encode())
+		for part in parts:
+			self.fh.write(part)
+		self.fh.write(b"\n")
+
+	def end(self):
+		pass
+
+	def close(self):
+		self.fh.close()
+
+#NEXUS (0=major, 1=minor, ?=N, -=gap) with the PHYLONET MLE_BiMarkers block, as dict2nexus
+class NexusWriter(MatrixWriter):
+	suffix = ".nex"
+
+	def begin(self, names, nchar, assign=None):
+		self.assign = assign
+		self.fh.write(nexusHeader(len(names), nchar).encode())
+
+	def end(self):
+		self.fh.write(b";\nEnd;\n")
+		if self.assign is not None:
+			self.fh.write(phylonetBlock(self.assign).encode())
+
+#Relaxed sequential PHYLIP of the numeric matrix
+class PhylipWriter(MatrixWriter):
+	suffix = ".phy"
+
+	def begin(self, names, nchar, assign=None):
+		self.fh.write(("%s %s\n"%(len(names), nchar)).encode())
+
+#Binary (0/1) NEXUS for SNAPP, with gaps written as missing data (?)
+#Rows keep their pop_N names, so species can be assigned by name prefix
+class SnappWriter(MatrixWriter):
+	suffix = ".snapp.nex"
+	TABLE = _byteTable({b"-":b"?"})
+
+	def begin(self, names, nchar, assign=None):
+		self.fh.write(("#NEXUS\n\nBegin data;\nDimensions ntax=" + str(len(names)) + " nchar=" + str(nchar) + ";\n").encode())
+		self.fh.write(b"Format datatype=binary symbols=\"01\" missing=?;\nMatrix\n\n")
+
+	def row(self, name, parts):
+		MatrixWriter.row(self, name, [self.TABLE[np.frombuffer(part, dtype=np.uint8)] for part in parts])
+
+	def end(self):
+		self.fh.write(b";\nEnd;\n")
+
+#NumPy .npy file of the (rows x sites) matrix as int8: 0=major, 1=minor, -1=N, -2=gap
+#Row names are not stored; they follow the order of the other outputs (and of the PHYLONET -taxa list)
+class BinaryWriter(MatrixWriter):
+	suffix = ".npy"
+	text = False
+	TABLE = _byteTable({b"0":b"\x00", b"1":b"\x01", b"?":b"\xff", b"-":b"\xfe"})
+
+	def begin(self, names, nchar, assign=None):
+		np.lib.format.write_array_header_1_0(self.fh, {"descr":"|i1", "fortran_order":False, "shape":(len(names), nchar)})
+
+	def row(self, name, parts):
+		for part in parts:
+			self.fh.write(self.TABLE[np.frombuffer(part, dtype=np.uint8)])
+
+#Output formats by name, in the order they are written
+OUTPUT_FORMATS = collections.OrderedDict((
+	("nexus", NexusWriter),
+	("phylip", PhylipWriter),
+	("snapp", SnappWriter),
+	("binary", BinaryWriter)
+))
+
+#Function returns dict of format -> output file for each of formats
+#NEXUS is written to out; other formats replace its extension (keeping a trailing .gz for
+#text formats), e.g. out.nex -> out.phy, out.snapp.nex, out.npy
+#Raises ValueError if two formats would be written to the same file (e.g. out.phy with phylip)
+def outputPaths(out, formats):
+	gz = ""
+	if out.endswith(".gz"):
+		out, gz = out[:-3], ".gz"
+	root = os.path.splitext(out)[0]
+	ret = collections.OrderedDict()
+	for fmt in OUTPUT_FORMATS:
+		if fmt not in formats:
+			continue
+		writer = OUTPUT_FORMATS[fmt]
+		if fmt == "nexus":
+			ret[fmt] = out + gz
+		else:
+			ret[fmt] = root + writer.suffix + (gz if writer.text else "")
+		for other, path in ret.items():
+			if other != fmt and path == ret[fmt]:
+				raise ValueError("Output formats %s and %s would both be written to %s (use another --out extension)"%(other, fmt, path))
+	return(ret)
+
+#Function returns a writer for each of formats, for output files named as in outputPaths
+#Raises OSError if a file can't be opened (closing those already opened)
+def openWriters(out, formats):
+	writers = list()
+	for fmt, path in outputPaths(out, formats).items():
+		try:
+			writers.append(OUTPUT_FORMATS[fmt](path))
+		except OSError:
+			for writer in writers:
+				writer.close()
+			raise
+	return(writers)
+
+#Function to write the rows of a BlockStore (encoded uint8 matrix) to every writer in one pass
+#Each row is read once, block by block, and the same blocks are passed to every writer, so
+#no copy of the whole matrix is made. assign = dict of row name -> pop (for NEXUS)
+#Raises OSError if writing fails; the writers are closed either way
+def writeMatrix(writers, names, store, assign=None):
+	try:
+		for writer in writers:
+			writer.begin(names, store.getSeqLen(), assign)
+		for r, name in enumerate(names):
+			parts = list(store.iterRow(r))
+			for writer in writers:
+				writer.row(name, parts)
+		for writer in writers:
+			writer.end()
+	finally:
+		for writer in writers:
+			writer.close()
+
+#Function returns "bgzf", "gzip", or None depending on how a file is compressed
+def compression(path):
+	with open(path, "rb") as fh:
+		head = fh.read(18)
+	if head[0:2] != b"\x1f\x8b":
+		return(None)
+	#BGZF: gzip with FEXTRA set and a "BC" extra subfield holding the block size
+	if len(head) >= 18 and head[3] & 4 and head[12:14] == b"BC":
+		return("bgzf")
+	return("gzip")
+
+#Function to open an alignment for reading as text, decompressing gzip or BGZF input
+#BGZF blocks are inflated in parallel by background threads (see iterBgzf); plain gzip is
+#inflated by one background thread, so parsing and decompression overlap
+def openInput(path, threads=None):
+	kind = compression(path)
+	if kind is None:
+		return(open(path, "r"))
+	if kind == "bgzf":
+		chunks = iterBgzf(path, threads)
+	else:
+		chunks = _readAhead(_iterGzip(path))
+	return(io.TextIOWrapper(io.BufferedReader(_ChunkStream(chunks), buffer_size=1 << 20)))
+
+#Generator yielding decompressed chunks of a gzip file
+def _iterGzip(path, size=1 << 22):
+	with gzip.open(path, "rb") as fh:
+		for chunk in iter(lambda: fh.read(size), b""):
+			yield(chunk)
+
+#Generator running another generator in a background thread, a few items ahead
+def _readAhead(chunks, depth=4):
+	queue = Queue(maxsize=depth)
+	def fill():
+		try:
+			for chunk in chunks:
+				queue.put(chunk)
+			queue.put(None)
+		except Exception as err:
+			queue.put(err)
+	thread = threading.Thread(target=fill, daemon=True)
+	thread.start()
+	while True:
+		item = queue.get()
+		if item is None:
+			break
+		if isinstance(item, Exception):
+			raise item
+		yield(item)
+
+#Function to read one BGZF block from fh. Returns the raw deflate data and the CRC32 and
+#uncompressed size from its footer, or None at end of file
+def _readBgzfBlock(fh):
+	header = fh.read(12)
+	if not header:
+		return(None)
+	if len(header) < 12 or header[0:2] != b"\x1f\x8b" or not header[3] & 4:
+		raise ValueError("Invalid BGZF block header in %s"%fh.name)
+	xlen = int.from_bytes(header[10:12], "little")
+	extra = fh.read(xlen)
+	bsize = None
+	pos = 0
+	while pos + 4 <= len(extra):
+		slen = int.from_bytes(extra[pos+2:pos+4], "little")
+		if extra[pos:pos+2] == b"BC" and slen == 2:
+			bsize = int.from_bytes(extra[pos+4:pos+6], "little")
+		pos += 4 + slen
+	if bsize is None:
+		raise ValueError("BGZF block without block size in %s"%fh.name)
+	cdata = fh.read(bsize - xlen - 19)
+	footer = fh.read(8)
+	return(cdata, int.from_bytes(footer[0:4], "little"), int.from_bytes(footer[4:8], "little"))
+
+#Function to inflate and check one BGZF block
+def _inflateBgzf(block):
+	cdata, crc, isize = block
+	data = zlib.decompress(cdata, -15)
+	if len(data) != isize or zlib.crc32(data) != crc:
+		raise ValueError("BGZF block failed CRC check")
+	return(data)
+
+#Generator yielding the decompressed blocks of a BGZF file, in order
+#Blocks are read sequentially and inflated on a pool of threads (zlib releases the GIL)
+def iterBgzf(path, threads=None):
+	if not threads:
+		threads = min(4, os.cpu_count() or 1)
+	with open(path, "rb") as fh, concurrent.futures.ThreadPoolExecutor(threads) as pool:
+		pending = collections.deque()
+		while True:
+			block = _readBgzfBlock(fh)
+			if block is not None:
+				pending.append(pool.submit(_inflateBgzf, block))
+			if pending and (block is None or len(pending) >= 4*threads):
+				data = pending.popleft().result()
+				if data:
+					yield(data)
+			if block is None and not pending:
+				break
+
+#Read-only raw stream over an iterator of bytes chunks (used to wrap decompressors)
+class _ChunkStream(io.RawIOBase):
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.current = b""
+		self.pos = 0
+
+	def readable(self):
+		return(True)
+
+	def readinto(self, buf):
+		while self.pos >= len(self.current):
+			self.current = next(self.chunks, None)
+			self.pos = 0
+			if self.current is None:
+				self.current = b""
+				return(0)
+		n = min(len(buf), len(self.current) - self.pos)
+		buf[0:n] = memoryview(self.current)[self.pos:self.pos+n]
+		self.pos += n
+		return(n)
 
 #Function to write an alignment as DICT to NEXUS
+#Values may be lists of characters, strings, bytes or uint8 arrays
 def dict2nexus(nex, aln):
-	with open(nex, 'w') as fh:
-		try:
-			slen = seq_tools.getSeqLen(aln)
-			header = "#NEXUS\n\nBegin data;\nDimensions ntax=" + str(len(aln)) + " nchar=" + str(slen) + ";\n"
-			header = header + "Format datatype=dna symbols=\"012\" missing=? gap=-;\nMatrix\n\n"
-			fh.write(header)
-			for seq in aln:
-				sline = str(seq) + " " + "".join(aln[seq]) + "\n"
-				fh.write(sline)
-			last = ";\nEnd;\n"
-			fh.write(last)
-		except IOError:
-			print("Could not read file ",nex)
-			sys.exit(1)
-		finally:
-			fh.close()
-
-#Reads an alignment as FASTA. returns dict of lists
-#key = sample name (FASTA header)
-#list = split sequence by character
-#handles interleaved or non-interleaved FASTA files
-def readFastaAlign(fas):
-	if not fileCheck(fas):
+	try:
+		fh = openOutput(nex)
+	except IOError:
+		print("Could not open file ",nex)
+		sys.exit(1)
+	try:
+		slen = seq_tools.getSeqLen(aln)
+		fh.write(nexusHeader(len(aln), slen).encode())
+		for seq in aln:
+			sequence = aln[seq]
+			if isinstance(sequence, list):
+				sequence = "".join(sequence)
+			if isinstance(sequence, str):
+				sequence = sequence.encode()
+			fh.write((str(seq) + " ").encode())
+			fh.write(sequence)
+			fh.write(b"\n")
+		fh.write(b";\nEnd;\n")
+	except IOError:
+		print("Could not write file ",nex)
+		sys.exit(1)
+	finally:
+		fh.close()
+
+#Reads an alignment as FASTA. returns an Alignment
+#row names = sample names (FASTA header)
+#handles interleaved or non-interleaved FASTA files, plain or gzip/BGZF-compressed
+def readFastaAlign(fas, threads=None, keep=None):
+	if not os.path.exists(fas):
 		raise FileNotFoundError("Fatal exception, file %s not found."%fas)
 
-	fh = open(fas)
+	fh = openInput(fas, threads)
 	try:
-		ret = dict()
+		names = list()
+		seqs = list()
+		skipped = [0, 0]
 		with fh as file_object:
 			contig = ""
-			seq = ""
+			seq = list()
+			skip = False
 			for line in file_object:
 				line = line.strip()
 				if not line:
@@ -89,43 +1198,105 @@ def readFastaAlign(fas):
 					#If we already loaded a contig, yield that contig and
 					#start loading a new one
 					if contig:
-						ret[contig] = seq.split()
+						names.append(contig)
+						seqs.append("".join(seq).encode())
 						contig = "" #reset contig and seq
-						seq = ""
-					contig = (line.replace(">",""))
+						seq = list()
+					#Samples not in keep are counted, but their sequence is not stored
+					skip = keep is not None and line.replace(">","") not in keep
+					if skip:
+						skipped[0] += 1
+					else:
+						contig = (line.replace(">",""))
+				elif skip:
+					skipped[1] += len(line)
 				else:
-					seq += line
+					seq.append(line)
 		#Iyield last sequence, if it has both a header and sequence
 		if contig and seq:
-			ret[contig] = seq.split()
+			names.append(contig)
+			seqs.append("".join(seq).encode())
+		ret = buildAlignment(names, seqs)
+		ret.skipped = skipped
 		return(ret)
 	finally:
 		fh.close()
 
-#Function to read a phylip file. Returns dict (key=sample) of lists (sequences divided by site)
-def readPhylip(phy):
+#Lookup table of byte -> uppercase byte
+_UPPER = np.frombuffer(bytes(range(256)).upper(), dtype=np.uint8)
+
+#Function to read rows of a ColumnReader as an uppercase matrix; takes a single tuple
+#(reader, rows) so it can be run by a process pool
+def _readRows(task):
+	reader, rows = task
+	return(_UPPER[reader.readBlock(0, reader.getSeqLen(), rows)])
+
+#Function to read an uncompressed FASTA file into an Alignment, through its .fai index
+#(see ColumnReader); groups of records are read by threads worker processes, each mapping
+#the file itself. keep = set of sample names to read (default all)
+#Returns an Alignment; raises ValueError if a sequence does not have a constant line width
+def readFastaIndexed(fas, threads=None, keep=None, chunk=1 << 26):
+	reader = ColumnReader(fas, "fasta", keep)
+	try:
+		nsites = reader.getSeqLen() or 0
+		mat = np.empty((len(reader.names), nsites), dtype=np.uint8)
+		step = max(1, chunk // max(nsites, 1))
+		tasks = [(reader, list(range(r, min(r+step, len(reader.names))))) for r in range(0, len(reader.names), step)]
+		if threads is not None and threads > 1 and len(tasks) > 1:
+			with concurrent.futures.ProcessPoolExecutor(min(threads, len(tasks))) as pool:
+				for (_, rows), block in zip(tasks, pool.map(_readRows, tasks)):
+					mat[rows[0]:rows[-1]+1] = block
+		else:
+			for task in tasks:
+				mat[task[1][0]:task[1][-1]+1] = _readRows(task)
+		ret = Alignment(reader.names, mat)
+		ret.skipped = list(reader.skipped)
+		return(ret)
+	finally:
+		reader.close()
+
+#Function to read a phylip file. Returns an Alignment (one row per sample)
+#Rows are written straight into a preallocated matrix sized from the header
+#File may be plain text or gzip/BGZF-compressed
+#keep = set of sample names to store (default all); the rows of other samples are
+#skipped, and counted in the skipped attribute of the Alignment
+def readPhylip(phy, threads=None, keep=None):
 	if os.path.exists(phy):
-		with open(phy, 'r') as fh:
+		with openInput(phy, threads) as fh:
 			try:
 				num=0
-				ret = dict()
+				names = list()
+				skipped = [0, 0]
+				mat = None
 				for line in fh:
 					line = line.strip()
 					if not line:
 						continue
 					num += 1
 					if num == 1:
+						ntax, nchar = [int(x) for x in line.split()[0:2]]
+						mat = np.empty((ntax if keep is None else min(ntax, len(keep)), nchar), dtype=np.uint8)
 						continue
 					arr = line.split()
-					ret[arr[0]] = list(arr[1])
+					if len(names) + skipped[0] >= ntax:
+						raise ValueError("PHYLIP file %s contains more than %s sequences."%(phy, ntax))
+					if len(arr[1]) != nchar:
+						raise ValueError("Sequence %s has length %s (expected %s)."%(arr[0], len(arr[1]), nchar))
+					if keep is not None and arr[0] not in keep:
+						skipped[0] += 1
+						skipped[1] += nchar
+						continue
+					mat[len(names)] = np.frombuffer(arr[1].upper().encode(), dtype=np.uint8)
+					names.append(arr[0])
+				if mat is None:
+					return(Alignment(list(), np.empty((0,0), dtype=np.uint8)))
+				ret = Alignment(names, mat[0:len(names)])
+				ret.skipped = skipped
 				return(ret)
-			except IOError:
-				print("Could not read file ",fas)
-				sys.exit(1)
 			finally:
 				fh.close()
 	else:
-		raise FileNotFoundError("File %s not found!"%fas)
+		raise FileNotFoundError("File %s not found!"%phy)
 
 
 #Write FASTA from pandas df where col1 is index, col2 is sequence
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+
+import sys
+import os
+import getopt
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import collections
+import numpy as np
+import aln_file_tools as aln
+import metrics_tools
+import pipeline
+
+"""Benchmarks for each stage of sampleBiMarkers on a synthetic alignment
+Results are written as JSON, so runs can be compared across commits"""
+
+def main():
+	params = parseArgs()
+
+	print("Simulating",params.samples,"samples x",params.sites,"sites in",params.pops,"populations...")
+	names, matrix, popmap = simulateAlignment(params.samples, params.sites, params.pops,
+		params.missing, params.het, params.gap, params.seed)
+	workdir = tempfile.mkdtemp(prefix="sbm_bench_", dir=params.tmpdir)
+	phy = os.path.join(workdir, "bench.phy")
+	fas = os.path.join(workdir, "bench.fasta")
+	nex = os.path.join(workdir, "bench.nex")
+	writeSimulated(phy, fas, names, matrix)
+	del matrix
+
+	stages = collections.OrderedDict()
+	try:
+		#Input is read as sampleBiMarkers.py reads it (pipeline.load): PHYLIP is indexed, and FASTA
+		#is read through a .fai index (rebuilt on each run); readPhylip and readFastaAlign parse
+		#compressed input
+		options = pipeline.Options(sample=params.sample, globalN=params.globalN, popN=params.popN, seed=params.seed,
+			threads=params.threads)
+		stages["index_phylip"], reader = runStage(params, lambda: pipeline.load(phy, "phylip", options), params.sites)
+		reader.close()
+		stages["parse_phylip_text"], _ = runStage(params, lambda: aln.readPhylip(phy), params.sites)
+		stages["parse_fasta"], seqs = runStage(params, lambda: loadFasta(fas, options), params.sites)
+		stages["parse_fasta_text"], _ = runStage(params, lambda: aln.readFastaAlign(fas), params.sites)
+
+		pops = list(collections.OrderedDict.fromkeys(popmap.values()))
+		popIndex = pipeline.selectPops(seqs, popmap)
+		rows, layout = pipeline.batchLayout([(popIndex, options)])
+
+		#Whole filter step on the parsed alignment, and on the same alignment packed two sites per byte
+		stages["pack"], packed = runStage(params, lambda: aln.packAlignment(seqs), params.sites)
+		stages["filter"], _ = runStage(params, lambda: pipeline.filterMarkers(seqs, popIndex, options), params.sites)
+		stages["filter_packed"], _ = runStage(params, lambda: pipeline.filterMarkers(packed, popIndex, options), params.sites)
+		storage = collections.OrderedDict((("unpacked", int(seqs.matrix.nbytes)), ("packed", int(packed.matrix.nbytes))))
+		packed.close()
+
+		#The global and per-population parts of the filter, timed (and their peak memory traced)
+		#by its own stages
+		filterStages, (kept, counts) = runFilter(params, seqs, rows, layout, options)
+		stages["global_filter"] = filterStages["global_filter"]
+		stages["pop_filter"] = filterStages["pop_filter"]
+		stages["pop_filter"]["sites_removed"] = int(params.sites - len(kept))
+		stages["sample"], sampled = runStage(params,
+			lambda: pipeline.sampleBlock(counts, kept, pops, options, params.seed), len(kept))
+		stages["encode"], encoded = runStage(params, lambda: pipeline.encodeBlock(sampled, options), len(kept))
+
+		store = aln.BlockStore(encoded.shape[0], inMemory=True)
+		store.append(encoded)
+		markers = pipeline.Markers(store, pipeline.outputAssign(pops, params.sample))
+		stages["write_nexus"], _ = runStage(params, lambda: pipeline.write(markers, nex), encoded.shape[1])
+	finally:
+		if not params.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+		else:
+			print("Kept benchmark files in",workdir)
+
+	report = collections.OrderedDict()
+	report["commit"] = gitCommit()
+	report["python"] = platform.python_version()
+	report["numpy"] = np.__version__
+	report["platform"] = platform.platform()
+	report["params"] = collections.OrderedDict((k, getattr(params, k)) for k in
+		("samples", "sites", "pops", "missing", "het", "gap", "sample", "globalN", "popN", "seed", "repeat", "threads"))
+	report["stages"] = stages
+	report["storage_bytes"] = storage
+	report["max_rss_kb"] = metrics_tools.maxRss()
+
+	for name, stage in stages.items():
+		print("%-19s wall %9.4fs  cpu %9.4fs  peak %10.1f MB  %s items"%(name, stage["wall"],
+			stage["cpu"], stage["peak_bytes"]/1e6, stage["items"]))
+	print("Alignment storage: %.1f MB unpacked, %.1f MB packed"%(storage["unpacked"]/1e6, storage["packed"]/1e6))
+	with open(params.out, "w") as fh:
+		json.dump(report, fh, indent=2)
+		fh.write("\n")
+	print("Wrote results to",params.out)
+
+#Function to run one benchmark stage params.repeat times
+#Returns (stats, result of the last call); stats has the best wall and CPU times (seconds),
+#all wall times, the peak traced memory of the stage (bytes) and the number of items processed
+def runStage(params, func, items):
+	walls = list()
+	cpus = list()
+	peak = 0
+	for i in range(params.repeat):
+		ret = None
+		tracemalloc.start()
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		ret = func()
+		cpus.append(time.process_time() - cpu)
+		walls.append(time.perf_counter() - wall)
+		peak = max(peak, tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+	stats = collections.OrderedDict()
+	stats["wall"] = min(walls)
+	stats["cpu"] = min(cpus)
+	stats["walls"] = walls
+	stats["peak_bytes"] = peak
+	stats["items"] = int(items)
+	return(stats, ret)
+
+#Function to load a FASTA file with pipeline.load, removing its .fai first so that every
+#run builds the index (as the first run on a file does)
+def loadFasta(fas, options):
+	if os.path.exists(fas + ".fai"):
+		os.remove(fas + ".fai")
+	return(pipeline.load(fas, "fasta", options))
+
+#Function to run the filter (pipeline.readMasks and pipeline.filterBlock, in blocks of
+#pipeline.blockSites sites as sampleBiMarkers.py does) params.repeat times, timing its
+#global_filter and pop_filter stages with a metrics_tools.RunMetrics
+#Returns (dict of stage -> stats as runStage, (indices of kept sites, allele counts) of the
+#last run), where peak_bytes is the peak memory allocated during any one pass through the stage
+def runFilter(params, seqs, rows, layout, options):
+	nsites = seqs.getSeqLen()
+	spans = pipeline.blockSpans(nsites, pipeline.blockSites(options, len(rows)))
+	runs = collections.OrderedDict((("global_filter", list()), ("pop_filter", list())))
+	for i in range(params.repeat):
+		metrics = metrics_tools.RunMetrics()
+		kept = list()
+		counts = list()
+		tracemalloc.start()
+		for start, end in spans:
+			k, c = pipeline.filterBlock(pipeline.readMasks(seqs, start, end, rows, metrics), layout, 1, metrics)[0]
+			kept.append(k + start)
+			counts.append(c)
+		tracemalloc.stop()
+		for name in runs:
+			runs[name].append(metrics.stages[name])
+	stats = collections.OrderedDict()
+	for name, times in runs.items():
+		stats[name] = collections.OrderedDict()
+		stats[name]["wall"] = min(run["wall"] for run in times)
+		stats[name]["cpu"] = min(run["cpu"] for run in times)
+		stats[name]["walls"] = [run["wall"] for run in times]
+		stats[name]["peak_bytes"] = max(run["peak_traced_bytes"] for run in times)
+		stats[name]["items"] = int(nsites)
+		stats[name]["block_sites"] = spans[0][1] - spans[0][0]
+	return(stats, (np.concatenate(kept), np.concatenate(counts, axis=2)))
+
+#Function to simulate a diploid SNP alignment with IUPAC heterozygotes
+#Each site has two random bases, with a random allele frequency in each population;
+#genotypes are heterozygous (IUPAC code) with probability het, and missing with probability
+#missing (a gap with probability gap, otherwise N)
+#Returns (sample names, (samples x sites) uint8 matrix, popmap dict of sample -> pop)
+def simulateAlignment(samples, sites, pops, missing=0.1, het=0.2, gap=0.1, seed=1):
+	rng = np.random.default_rng(seed)
+	bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+	hets = np.array([[0, ord("M"), ord("R"), ord("W")],
+		[ord("M"), 0, ord("S"), ord("Y")],
+		[ord("R"), ord("S"), 0, ord("K")],
+		[ord("W"), ord("Y"), ord("K"), 0]], dtype=np.uint8)
+	first = rng.integers(0, 4, sites)
+	second = (first + rng.integers(1, 4, sites)) % 4
+	popOf = np.arange(samples) % pops
+	freq = rng.random((pops, sites))
+
+	matrix = np.empty((samples, sites), dtype=np.uint8)
+	for i in range(samples):
+		alt = rng.random(sites) < freq[popOf[i]]
+		matrix[i] = np.where(alt, bases[second], bases[first])
+		isHet = rng.random(sites) < het
+		matrix[i, isHet] = hets[first[isHet], second[isHet]]
+		isMissing = rng.random(sites) < missing
+		isGap = isMissing & (rng.random(sites) < gap)
+		matrix[i, isMissing] = ord("N")
+		matrix[i, isGap] = ord("-")
+
+	names = ["sample" + str(i) for i in range(samples)]
+	popmap = collections.OrderedDict((name, "pop" + str(popOf[i])) for i, name in enumerate(names))
+	return(names, matrix, popmap)
+
+#Function writes a simulated alignment as sequential PHYLIP and FASTA (wrapped at width bases per line)
+def writeSimulated(phy, fas, names, matrix, width=60):
+	with open(phy, "wb") as fh:
+		fh.write(("%s %s\n"%matrix.shape).encode())
+		for name, row in zip(names, matrix):
+			fh.write(name.encode() + b" " + row.tobytes() + b"\n")
+	with open(fas, "wb") as fh:
+		for name, row in zip(names, matrix):
+			seq = row.tobytes()
+			fh.write(b">" + name.encode() + b"\n" + b"\n".join(seq[i:i+width] for i in range(0, len(seq), width)) + b"\n")
+
+#Function returns the current git commit of this script, or None
+def gitCommit():
+	try:
+		out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+		return(out.stdout.decode().strip())
+	except (OSError, subprocess.CalledProcessError):
+		return(None)
+
+#Object to parse command-line arguments
+class parseArgs():
+	def __init__(self):
+		#Define options
+		try:
+			options, remainder = getopt.getopt(sys.argv[1:], 'ho:', \
+			["help","out=","samples=","sites=","pops=","missing=","het=","gap=","sample=",
+			"maxN=","popN=","seed=","repeat=","threads=","tmpdir=","keep"])
+		except getopt.GetoptError as err:
+			print(err)
+			self.display_help("\nExiting because getopt returned non-zero exit status.")
+		#Default values for params
+		self.out="benchmark.json"
+		self.samples=100
+		self.sites=100000
+		self.pops=4
+		self.missing=0.1
+		self.het=0.2
+		self.gap=0.1
+		self.sample=2
+		self.globalN=0.5
+		self.popN=0.5
+		self.seed=1
+		self.repeat=3
+		self.threads=1
+		self.tmpdir=None
+		self.keep=False
+
+		for opt, arg_raw in options:
+			arg = arg_raw.strip()
+			opt = opt.replace("-","")
+			if opt in ('h', 'help'):
+				self.display_help("Exiting because help menu was called.")
+			elif opt in ('o', 'out'):
+				self.out = arg
+			elif opt == "samples":
+				self.samples = int(arg)
+			elif opt == "sites":
+				self.sites = int(arg)
+			elif opt == "pops":
+				self.pops = int(arg)
+			elif opt == "missing":
+				self.missing = float(arg)
+			elif opt == "het":
+				self.het = float(arg)
+			elif opt == "gap":
+				self.gap = float(arg)
+			elif opt == "sample":
+				self.sample = int(arg)
+			elif opt == "maxN":
+				self.globalN = float(arg)
+			elif opt == "popN":
+				self.popN = float(arg)
+			elif opt == "seed":
+				self.seed = int(arg)
+			elif opt == "repeat":
+				self.repeat = int(arg)
+			elif opt == "threads":
+				self.threads = int(arg)
+			elif opt == "tmpdir":
+				self.tmpdir = arg
+			elif opt == "keep":
+				self.keep = True
+			else:
+				assert False, "Unhandled option %r"%opt
+
+		if self.samples < 1 or self.sites < 1 or self.repeat < 1:
+			self.display_help("Error: --samples, --sites and --repeat must be greater than 0.")
+		if self.pops < 1 or self.pops > self.samples:
+			self.display_help("Error: --pops must be between 1 and --samples.")
+		for rate in (self.missing, self.het, self.gap):
+			if rate < 0.0 or rate > 1.0:
+				self.display_help("Error: --missing, --het and --gap must be between 0 and 1.")
+
+	def display_help(self, message=None):
+		if message is not None:
+			print ("\n",message)
+		print ("\nbenchmark.py\n")
+		print ("Usage: ", sys.argv[0], "--samples 100 --sites 100000 -o results.json\n")
+		print ("Description: Times each stage of sampleBiMarkers on a simulated alignment")
+
+		print("""
+	Arguments:
+		SIMULATED DATA
+		--samples	: Number of samples [default=100]
+		--sites		: Number of alignment columns [default=100000]
+		--pops		: Number of populations (samples are assigned in turn) [default=4]
+		--missing	: Probability that a genotype is missing [default=0.1]
+		--het		: Probability that a genotype is heterozygous (IUPAC code) [default=0.2]
+		--gap		: Proportion of missing genotypes written as gaps rather than N [default=0.1]
+		--seed		: Random seed for simulation and sampling [default=1]
+
+		SAMPLING
+		--sample	: Number of alleles to sample per population [default=2]
+		--maxN		: As sampleBiMarkers.py -N [default=0.5]
+		--popN		: As sampleBiMarkers.py -n [default=0.5]
+
+		BENCHMARK
+		-o,--out	: JSON results file [default=benchmark.json]
+		--repeat	: Times each stage is run; the fastest is reported [default=3]
+		--threads	: Worker processes for parse_fasta [default=1]
+		--tmpdir	: Directory for the simulated files [default=$TMPDIR]
+		--keep		: Toggle on to keep the simulated files
+		-h,--help	: Displays help menu
+
+		Stages: index_phylip, parse_phylip_text, parse_fasta, parse_fasta_text, pack, filter, filter_packed, global_filter, pop_filter,
+		sample, encode, write_nexus
+		Each stage records best wall and CPU time, peak memory allocated during the stage
+		(traced with tracemalloc, which includes NumPy arrays) and items (sites) processed.
+		Every stage times the code sampleBiMarkers.py runs: index_phylip and parse_fasta are
+		pipeline.load (a PHYLIP index, and FASTA read through a newly built .fai index), and
+		parse_phylip_text and parse_fasta_text read the whole file with the parsers used for
+		compressed PHYLIP and FASTA. global_filter and pop_filter
+		are the stages of pipeline.filterBlock, run in blocks as sampleBiMarkers.py does (block_sites),
+		as timed by --metrics; peak_bytes is the most allocated during one block of that stage.
+		filter and filter_packed run the whole filter step (pipeline.filterMarkers) on the parsed
+		alignment and on a copy packed two sites per byte (--packed); the bytes each one holds
+		the alignment in are reported as storage_bytes. Peak RSS of the whole run is reported as max_rss_kb.
+
+""")
+		sys.exit()
+
+#Call main function
+if __name__ == '__main__':
+    main()
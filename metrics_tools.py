@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+import sys
+import time
+import resource
+import contextlib
+import collections
+import cProfile
+import tracemalloc
+
+"""Per-stage run metrics (wall time, CPU time, peak RSS, items processed) for sampleBiMarkers"""
+
+#Object accumulating metrics for named stages, and named counters (e.g. sites removed)
+#Stages may be entered many times (once per block); times and items are summed
+#Objects from worker processes are combined with merge(), so stage times are summed over
+#processes (busy time, which can exceed the wall time of the run)
+#If profile, each stage is also run under its own cProfile profiler (in this process only)
+class RunMetrics():
+	def __init__(self, profile=False):
+		self.stages = collections.OrderedDict()
+		self.counters = collections.OrderedDict()
+		self.profile = profile
+		self.profilers = dict()
+		self.profiledWall = dict() #wall time spent under each profiler (this process only)
+		self.peaks = list() #peak RSS (kB) of each stage being run, innermost last
+		self.traced = list() #peak traced memory (bytes) of each stage being run, if tracing
+
+	#Workers don't send their profilers back
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["profilers"] = dict()
+		state["profiledWall"] = dict()
+		return(state)
+
+	def _stage(self, name):
+		if name not in self.stages:
+			self.stages[name] = collections.OrderedDict((("wall", 0.0), ("cpu", 0.0), ("calls", 0), ("items", 0), ("max_rss_kb", 0)))
+		return(self.stages[name])
+
+	#Context manager timing one pass through a stage, which processed items things (e.g. sites)
+	@contextlib.contextmanager
+	def stage(self, name, items=0):
+		prof = None
+		if self.profile:
+			prof = self.profilers.setdefault(name, cProfile.Profile())
+			prof.enable()
+		#the peak so far belongs to the enclosing stage (if any), before it is reset for this one
+		if self.peaks:
+			self.peaks[-1] = max(self.peaks[-1], peakRss())
+		resetPeakRss()
+		self.peaks.append(0)
+		#With tracemalloc running (e.g. in benchmark.py), also record the peak memory allocated
+		#during the stage (including NumPy arrays), above what was allocated when it started
+		tracing = tracemalloc.is_tracing()
+		if tracing:
+			if self.traced:
+				self.traced[-1] = max(self.traced[-1], tracemalloc.get_traced_memory()[1])
+			base = tracemalloc.get_traced_memory()[0]
+			tracemalloc.reset_peak()
+			self.traced.append(0)
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield(self)
+		finally:
+			cpu = time.process_time() - cpu
+			wall = time.perf_counter() - wall
+			if prof is not None:
+				prof.disable()
+				self.profiledWall[name] = self.profiledWall.get(name, 0.0) + wall
+			peak = max(self.peaks.pop(), peakRss())
+			if self.peaks:
+				self.peaks[-1] = max(self.peaks[-1], peak)
+			stats = self._stage(name)
+			stats["wall"] += wall
+			stats["cpu"] += cpu
+			stats["calls"] += 1
+			stats["items"] += int(items)
+			stats["max_rss_kb"] = max(stats["max_rss_kb"], peak)
+			if tracing:
+				traced = max(self.traced.pop(), tracemalloc.get_traced_memory()[1])
+				if self.traced:
+					self.traced[-1] = max(self.traced[-1], traced)
+				stats["peak_traced_bytes"] = max(stats.get("peak_traced_bytes", 0), traced - base)
+
+	#Adds n to a counter
+	def count(self, name, n):
+		self.counters[name] = self.counters.get(name, 0) + int(n)
+
+	#Adds the stages and counters of another RunMetrics (or does nothing if other is None)
+	def merge(self, other):
+		if other is None:
+			return
+		for name, theirs in other.stages.items():
+			ours = self._stage(name)
+			for key in ("wall", "cpu", "calls", "items"):
+				ours[key] += theirs[key]
+			ours["max_rss_kb"] = max(ours["max_rss_kb"], theirs["max_rss_kb"])
+		for name, n in other.counters.items():
+			self.count(name, n)
+
+	#Writes the cProfile stats of the profiled stage that took longest in this process (pstats format)
+	#Time stages spent in worker processes is not profiled, so isn't counted; returns its name
+	def dumpProfile(self, path):
+		profiled = [name for name in self.stages if name in self.profilers]
+		if not profiled:
+			return(None)
+		name = max(profiled, key=lambda name: self.profiledWall.get(name, 0.0))
+		self.profilers[name].dump_stats(path)
+		return(name)
+
+	#Returns a dict of all metrics, for writing as JSON
+	def report(self, wall=None, extra=None):
+		ret = collections.OrderedDict()
+		ret["command"] = sys.argv
+		if wall is not None:
+			ret["wall"] = wall
+		ret["stages"] = self.stages
+		ret["counters"] = self.counters
+		ret["max_rss_kb"] = maxRss()
+		ret["max_rss_children_kb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+		if extra:
+			ret.update(extra)
+		return(ret)
+
+	#Prints a summary table of the stages
+	def summary(self):
+		for name, stats in self.stages.items():
+			print("  %-14s wall %10.3fs  cpu %10.3fs  peak RSS %8.1f MB  %s items"%(name, stats["wall"],
+				stats["cpu"], stats["max_rss_kb"]/1024.0, stats["items"]))
+		for name, n in self.counters.items():
+			print("  %-24s %s"%(name, n))
+
+#Highest peak RSS (kB) seen before the peak was last reset by resetPeakRss
+_resetPeak = 0
+
+#Peak resident set size of this process so far, in kB (including any peak since reset)
+def maxRss():
+	return(max(_resetPeak, peakRss()))
+
+#Peak resident set size since the last resetPeakRss (or since the process started), in kB
+#Read from VmHWM on Linux; ru_maxrss elsewhere (which is never reset)
+def peakRss():
+	try:
+		with open("/proc/self/status", "r") as fh:
+			for line in fh:
+				if line.startswith("VmHWM:"):
+					return(int(line.split()[1]))
+	except OSError:
+		pass
+	return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+#Function resets the peak RSS of this process to its current RSS, so that peakRss gives the
+#peak of what follows (Linux only: writes 5 to /proc/self/clear_refs). Elsewhere, or if this
+#is not allowed, peakRss stays the peak of the whole process
+def resetPeakRss():
+	global _resetPeak
+	_resetPeak = max(_resetPeak, peakRss())
+	try:
+		with open("/proc/self/clear_refs", "w") as fh:
+			fh.write("5")
+	except OSError:
+		pass
+
+#Returns metrics.stage(name, items), or a no-op context manager if metrics is None
+def stage(metrics, name, items=0):
+	if metrics is None:
+		return(contextlib.nullcontext())
+	return(metrics.stage(name, items))
+
+#Calls metrics.count(name, n), unless metrics is None
+def count(metrics, name, n):
+	if metrics is not None:
+		metrics.count(name, n)
@@ -0,0 +1,826 @@
+#!/usr/bin/python
+
+import random
+import itertools
+import collections
+import numpy as np
+import aln_file_tools as aln
+import seq_tools as seq
+import vcf_tools as vcf
+import metrics_tools
+
+"""In-process API for sampling bi-allelic markers (sampleBiMarkers.py is a wrapper around it)
+Steps are load -> selectPops -> filterMarkers -> sample -> encode -> write, each taking and
+returning in-memory objects, so one alignment can be loaded once and sampled many times:
+
+	seqs = pipeline.load("data.phy", "phylip")
+	options = pipeline.Options(sample=2, seed=5)
+	popIndex = pipeline.selectPops(seqs, "popmap.txt")
+	filtered = pipeline.filterMarkers(seqs, popIndex, options)
+	encoded = pipeline.encode(pipeline.sample(filtered, options), options)
+	pipeline.write(encoded, "out.nex")
+
+Every step takes an optional multiprocessing.Pool to process blocks of sites in parallel
+(output does not depend on it), and an optional metrics_tools.RunMetrics
+Errors in the data (invalid characters, too few alleles to sample) raise ValueError, and
+files that can't be read or written raise OSError; nothing is printed, and nothing exits"""
+
+#Object holding settings for the pipeline steps, with the same names and defaults as the
+#sampleBiMarkers.py options (which can be used in its place)
+class Options():
+	def __init__(self, **kwargs):
+		self.sample=1
+		self.globalN=0.5
+		self.popN=0.5
+		self.allowN=False
+		self.allowG=False
+		self.allowM=False
+		self.keepG=False
+		self.seed=None
+		self.chunkSites=None
+		self.cache=False
+		self.cacheDir=None
+		self.replicates=1
+		self.threads=1
+		self.packed=False
+		self.maxSites=None
+		self.loci=None
+		self.sites=None
+		self.regions=None
+		self.formats=["nexus"]
+		for key, value in kwargs.items():
+			if not hasattr(self, key):
+				raise TypeError("Unknown option %s"%key)
+			setattr(self, key, value)
+		if self.seed is None:
+			self.seed = random.SystemRandom().getrandbits(32)
+
+#Function returns a copy of options (Options, or the sampleBiMarkers.py options) as Options,
+#with some settings changed
+def optionsFrom(options, **changes):
+	ret = Options(seed=options.seed)
+	for key in vars(ret):
+		if hasattr(options, key):
+			setattr(ret, key, getattr(options, key))
+	for key, value in changes.items():
+		if not hasattr(ret, key):
+			raise TypeError("Unknown option %s"%key)
+		setattr(ret, key, value)
+	return(ret)
+
+#Object describing one configuration of a batch: output file, popmap (file or dict),
+#Options, and populations to include or exclude
+class BatchConfig():
+	def __init__(self, out, popmap, options, include=None, exclude=None):
+		self.out = out
+		self.popmap = popmap
+		self.options = options
+		self.include = include if include else list()
+		self.exclude = exclude if exclude else list()
+
+#Manifest columns, and the Options setting (and type) of those which are settings
+MANIFEST_COLUMNS = collections.OrderedDict((
+	("out", None),
+	("popmap", None),
+	("include", None),
+	("exclude", None),
+	("sample", ("sample", int)),
+	("maxN", ("globalN", float)),
+	("popN", ("popN", float)),
+	("seed", ("seed", int)),
+	("maxSites", ("maxSites", int)),
+	("loci", ("loci", str))
+))
+
+#Function to read a tab-delimited batch manifest, with a header line naming its columns
+#(out is required; see MANIFEST_COLUMNS). Empty cells, and missing columns, take their value
+#from options (and popmap); include and exclude are comma-separated lists of pops
+#needPopmap = False if configurations may have no popmap (e.g. for a count summary)
+#Lines starting with # are ignored. Returns list of BatchConfig; raises ValueError if invalid
+def parseManifest(manifest, options, popmap=None, needPopmap=True):
+	ret = list()
+	header = None
+	with open(manifest, "r") as fh:
+		for number, line in enumerate(fh, 1):
+			line = line.rstrip("\r\n")
+			if not line.strip() or line.startswith("#"):
+				continue
+			fields = [field.strip() for field in line.split("\t")]
+			if header is None:
+				header = fields
+				for column in header:
+					if column not in MANIFEST_COLUMNS:
+						raise ValueError("Unknown column %s in batch manifest %s (expected %s)"%(column, manifest, ", ".join(MANIFEST_COLUMNS)))
+				if "out" not in header:
+					raise ValueError("Batch manifest %s needs an out column"%manifest)
+				continue
+			if len(fields) > len(header):
+				raise ValueError("Line %s of batch manifest %s has more columns than its header"%(number, manifest))
+			row = dict((column, value) for column, value in zip(header, fields) if value)
+			if "out" not in row:
+				raise ValueError("Line %s of batch manifest %s has no output file"%(number, manifest))
+			if any(config.out == row["out"] for config in ret):
+				raise ValueError("Line %s of batch manifest %s has the same output file as an earlier line: %s"%(number, manifest, row["out"]))
+			changes = dict()
+			try:
+				for column, value in row.items():
+					if MANIFEST_COLUMNS[column] is not None:
+						key, convert = MANIFEST_COLUMNS[column]
+						changes[key] = convert(value)
+			except ValueError:
+				raise ValueError("Line %s of batch manifest %s has an invalid %s: %s"%(number, manifest, column, value))
+			if needPopmap and row.get("popmap", popmap) is None:
+				raise ValueError("Line %s of batch manifest %s has no popmap (give one with -p, or a popmap column)"%(number, manifest))
+			ret.append(BatchConfig(row["out"], row.get("popmap", popmap), optionsFrom(options, **changes),
+				row["include"].split(",") if "include" in row else None,
+				row["exclude"].split(",") if "exclude" in row else None))
+	if not ret:
+		raise ValueError("Batch manifest %s has no configurations"%manifest)
+	return(ret)
+
+#Function to open an alignment ("phylip" or "fasta"), VCF ("vcf") or count summary
+#("summary", see summarize) file for filterMarkers
+#Uncompressed PHYLIP (or FASTA with options.chunkSites) is indexed and read in blocks of
+#columns; with options.cache, a binary cache is memory-mapped; uncompressed FASTA with
+#options.sites or regions is read the same way if its line width is constant; other
+#uncompressed FASTA is read into memory in parallel through its .fai index; otherwise the
+#file is parsed into memory (and only the selected columns are then used). With options.packed, an alignment is then packed into memory as 4-bit masks,
+#one block of columns at a time (see aln_file_tools.PackedAlignment)
+#samples = sample names to read (e.g. from selectSamples; default all). PHYLIP and FASTA
+#records of other samples are skipped without being stored (see the skipped attribute);
+#a cache always holds every sample, but only the rows used are read from it
+#Returns an Alignment, ColumnReader, PackedAlignment, VcfReader or CountSummary (close() it when done)
+#Note that a VcfReader is a stream, and can only be filtered once
+def load(path, fmt="phylip", options=None, metrics=None, samples=None):
+	if options is None:
+		options = Options()
+	if fmt not in ("phylip", "fasta", "vcf", "summary"):
+		raise ValueError("Unknown input format %s"%fmt)
+	threads = options.threads if options.threads > 1 else None
+	keep = None if samples is None else set(samples)
+	with metrics_tools.stage(metrics, "parse"):
+		if fmt == "vcf":
+			return(vcf.VcfReader(path, threads))
+		elif fmt == "summary":
+			return(aln.CountSummary(path))
+		elif options.cache:
+			seqs = aln.loadCached(path, fmt, options.cacheDir)
+		elif not aln.compression(path) and (fmt == "phylip" or options.chunkSites):
+			seqs = aln.ColumnReader(path, fmt, keep)
+		elif fmt == "phylip":
+			seqs = aln.readPhylip(path, threads, keep)
+		elif not aln.compression(path):
+			seqs = None
+			if options.sites or options.regions:
+				#only the selected columns of each row are read if the line width is constant
+				try:
+					seqs = aln.ColumnReader(path, fmt, keep)
+				except ValueError:
+					pass
+			if seqs is None:
+				try:
+					seqs = aln.readFastaIndexed(path, threads, keep)
+				except ValueError:
+					seqs = aln.readFastaAlign(path, threads, keep)
+		else:
+			seqs = aln.readFastaAlign(path, threads, keep)
+	metrics_tools.count(metrics, "skipped_records", seqs.skipped[0])
+	metrics_tools.count(metrics, "skipped_bytes", seqs.skipped[1])
+	if not options.packed:
+		return(seqs)
+	with metrics_tools.stage(metrics, "pack", seqs.getSeqLen()):
+		try:
+			packed = aln.packAlignment(seqs, blockSites(options, len(seqs)))
+		finally:
+			seqs.close()
+	return(packed)
+
+#Target size (bytes) of a block of masks (one byte per genotype) without options.chunkSites
+BLOCK_BYTES = 64 << 20
+
+#Function returns the number of sites per block when reading nrows rows: options.chunkSites,
+#or as many as keep a block of masks near BLOCK_BYTES (1024 to 65536 sites), so that the
+#memory used per block does not grow with the number of samples
+#Output does not depend on the block size
+def blockSites(options, nrows):
+	if options.chunkSites:
+		return(options.chunkSites)
+	return(int(min(65536, max(1024, BLOCK_BYTES // max(nrows, 1)))))
+
+#Function returns the set of samples (of a popmap file or dict of sample -> pop) whose
+#population is selected, minus exclude (or only those in include), e.g. for load
+#Raises ValueError if no samples are selected, so that nothing is read for an empty selection
+def selectSamples(popmap, include=None, exclude=None):
+	if isinstance(popmap, str):
+		popmap = aln.parsePopmap(popmap)
+	ret = set(ind for ind, pop in popmap.items() if (not include or pop in include) and (not exclude or pop not in exclude))
+	if not ret:
+		raise ValueError("Oops! No populations remaining. Check that selections using --include or --exclude match the populations in your popmap file! :)")
+	return(ret)
+
+#Function returns the column ranges of an alignment of nsites columns selected by
+#options.sites (e.g. "1-1000,5001-6000": 1-based, inclusive) and options.regions (BED file),
+#as a sorted list of merged (start, end) ranges (0-based, end-exclusive) clipped to nsites
+#Returns None if neither is set; raises ValueError if invalid, or if no columns are selected
+def siteRanges(options, nsites):
+	if not options.sites and not options.regions:
+		return(None)
+	ranges = list()
+	if options.sites:
+		for item in str(options.sites).split(","):
+			bounds = item.split("-")
+			try:
+				start, end = int(bounds[0]), int(bounds[-1])
+			except ValueError:
+				raise ValueError("Invalid site range %s (expected e.g. 1-1000)"%item)
+			if len(bounds) > 2 or start < 1 or end < start:
+				raise ValueError("Invalid site range %s (expected e.g. 1-1000)"%item)
+			ranges.append((start-1, end))
+	if options.regions:
+		ranges.extend(aln.parseRegions(options.regions))
+	merged = list()
+	for start, end in sorted(ranges):
+		start, end = min(start, nsites), min(end, nsites)
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+		elif end > start:
+			merged.append((start, end))
+	if not merged:
+		raise ValueError("No selected sites are within the alignment (%s columns)"%nsites)
+	return(merged)
+
+#Function returns list of (start, end) blocks of up to block columns covering ranges
+#(from siteRanges), or the whole alignment of nsites columns if ranges is None
+def blockSpans(nsites, block, ranges=None):
+	if ranges is None:
+		ranges = [(0, nsites)]
+	return([(start, min(start+block, end)) for first, end in ranges for start in range(first, end, block)])
+
+#Function to group the samples of an alignment by population
+#popmap = popmap file or dict of sample -> pop; pops keep their order of first appearance,
+#minus exclude (or only those in include). Samples without data or a pop are dropped
+#For a CountSummary, the popmap is ignored (samples were already grouped by summarize)
+#Returns dict of pop -> array of rows; raises ValueError if no populations remain
+def selectPops(seqs, popmap, include=None, exclude=None, metrics=None):
+	with metrics_tools.stage(metrics, "popmap", len(seqs)):
+		if isinstance(seqs, aln.CountSummary):
+			popmap = collections.OrderedDict((pop, pop) for pop in seqs.pops)
+			index = seqs.popIndex
+		else:
+			if isinstance(popmap, str):
+				popmap = aln.parsePopmap(popmap)
+			popmap = aln.cleanPopmap(popmap, seqs.index)
+		pops = collections.OrderedDict()
+		for pop in popmap.values():
+			if (not include or pop in include) and (not exclude or pop not in exclude):
+				pops[pop] = True
+		if len(pops) < 1:
+			raise ValueError("Oops! No populations remaining. Check that popmap sample names match those in your data file, or that selections using --include or --exclude are correct! :)")
+		if isinstance(seqs, aln.CountSummary):
+			return(collections.OrderedDict((pop, index[pop]) for pop in pops))
+		return(aln.groupRows(seqs.index, popmap, pops))
+
+#Object holding the result of filterMarkers: per-population allele counts at passing sites
+#pops = population names; sizes = samples per population; nsites = sites (or VCF records) read
+#counts = BlockStore of (pops*6 x sites) allele counts; sites = BlockStore of (1 x sites)
+#site indices (which key the random numbers used by sample)
+class Filtered():
+	def __init__(self, pops, sizes, counts, sites, nsites=0, nsnps=None):
+		self.pops = list(pops)
+		self.sizes = list(sizes)
+		self.counts = counts
+		self.sites = sites
+		self.nsites = nsites
+		self.nsnps = nsnps
+		self.thinned = 0 #passing sites removed by options.loci or options.maxSites
+
+	#Returns number of sites passing the filters
+	def getSeqLen(self):
+		return(self.counts.getSeqLen())
+
+	#Generator yielding ((pops x 6 x sites) allele counts, site indices) for each block
+	def iterBlocks(self):
+		for counts, sites in zip(self.counts.iterBlocks(), self.sites.iterBlocks()):
+			yield(counts.reshape(len(self.pops), 6, counts.shape[1]), sites[0])
+
+	def close(self):
+		self.counts.close()
+		self.sites.close()
+
+#Object holding sampled (characters) or encoded (0, 1, ?, -) markers
+#store = BlockStore of (rows x sites) blocks; assign = dict of row name -> pop, in row order
+class Markers():
+	def __init__(self, store, assign):
+		self.store = store
+		self.assign = assign
+		self.names = list(assign)
+
+	def getSeqLen(self):
+		return(self.store.getSeqLen())
+
+	def iterBlocks(self):
+		return(self.store.iterBlocks())
+
+	def close(self):
+		self.store.close()
+
+#Function to apply the biallelic, globalN (--maxN) and popN (--popN) filters to every site
+#(or those in options.sites and options.regions), one block of sites at a time (see blockSites)
+#seqs = from load; popIndex = from selectPops
+#Counts are kept on disk with options.chunkSites or options.replicates > 1, else in memory
+#Returns a Filtered; raises ValueError for invalid characters, or too few alleles to sample
+def filterMarkers(seqs, popIndex, options, metrics=None, pool=None):
+	return(filterBatch(seqs, [(popIndex, options)], metrics, pool)[0])
+
+#Same as filterMarkers, for many configurations (popIndex, options) in one pass over seqs
+#Each block is read once for all samples in any configuration and converted to masks once;
+#states, missing and allele counts are computed once for each distinct grouping of samples
+#(configurations differing only in --sample, --maxN, --popN or --seed share all of them)
+#Block size and selected columns (options.sites, options.regions) are those of the first
+#configuration. Returns a list of Filtered
+#If label is given for a configuration (a third tuple item), its metrics counters are
+#prefixed with "label:"
+def filterBatch(seqs, configs, metrics=None, pool=None):
+	allRows, layout = batchLayout(configs)
+	options = configs[0][1]
+	block = blockSites(options, len(allRows))
+	keepMetrics = metrics is not None
+
+	#Workers re-map the alignment file (or a temporary copy of an in-memory alignment)
+	#VCF records are parsed in order in this process
+	shared = seqs
+	if isinstance(seqs, aln.CountSummary):
+		results = filterSummary(seqs, layout, len(configs), block, metrics)
+	elif isinstance(seqs, vcf.VcfReader):
+		results = filterVcf(seqs, allRows, layout, len(configs), block, metrics)
+	else:
+		#only the blocks in options.sites/options.regions are read; sites keep their alignment index
+		spans = blockSpans(seqs.getSeqLen(), block, siteRanges(options, seqs.getSeqLen()))
+		alen = sum(end-start for start, end in spans)
+		if pool is not None:
+			if isinstance(seqs, aln.Alignment):
+				shared = aln.memmapAlignment(seqs)
+			tasks = [(shared, start, end, allRows, layout, len(configs), keepMetrics) for start, end in spans]
+			filtered = mergeMetrics(pool.imap(filterTask, tasks), metrics)
+		else:
+			filtered = (readFilterBlock(seqs, start, end, allRows, layout, len(configs), metrics) for start, end in spans)
+		results = ([(kept+start, counts) for kept, counts in ret] for (start, end), ret in zip(spans, filtered))
+
+	#counts are kept on disk if streaming, or if they will be read by worker processes
+	#With options.loci or options.maxSites, passing sites are thinned as they stream past
+	stores = list()
+	thinners = list()
+	loci = dict()
+	for config in configs:
+		popIndex, options = config[0:2]
+		sizes = [len(idx) for idx in popIndex.values()]
+		inMemory = not options.chunkSites and options.replicates == 1 and len(configs) == 1
+		stores.append((aln.BlockStore(len(popIndex)*6, inMemory=inMemory, dtype=seq.countDtype(sizes)),
+			aln.BlockStore(1, inMemory=inMemory, dtype=np.int64)))
+		if options.loci and options.loci not in loci:
+			loci[options.loci] = aln.parseLoci(options.loci)
+		if options.loci or options.maxSites:
+			thinners.append(SiteThinner(options, loci.get(options.loci), config[2] if len(config) > 2 else None, metrics))
+		else:
+			thinners.append(None)
+	try:
+		for ret in itertools.chain(results, [[None]*len(configs)]):
+			for (countStore, siteStore), thinner, block in zip(stores, thinners, ret):
+				if thinner is not None:
+					block = thinner.add(*block) if block is not None else thinner.finish()
+				if block is None:
+					continue
+				sites, counts = block
+				countStore.append(counts.reshape(counts.shape[0]*6, len(sites)))
+				siteStore.append(sites.reshape(1, len(sites)))
+	except ValueError:
+		for countStore, siteStore in stores:
+			countStore.close()
+			siteStore.close()
+		raise
+	finally:
+		if shared is not seqs:
+			shared.close()
+	ret = list()
+	for (popIndex, options), (countStore, siteStore) in zip((config[0:2] for config in configs), stores):
+		sizes = [len(idx) for idx in popIndex.values()]
+		if isinstance(seqs, aln.CountSummary):
+			ret.append(Filtered(popIndex, sizes, countStore, siteStore, seqs.inputSites, seqs.inputSnps))
+		elif isinstance(seqs, vcf.VcfReader):
+			ret.append(Filtered(popIndex, sizes, countStore, siteStore, seqs.nrecords, seqs.nsnps))
+		else:
+			ret.append(Filtered(popIndex, sizes, countStore, siteStore, alen))
+	for result, thinner in zip(ret, thinners):
+		if thinner is not None:
+			result.thinned = thinner.removed
+	return(ret)
+
+#Stream ID for the random keys of SiteThinner; pop streams (crc32) are below 2^32
+THIN_STREAM = 1 << 32
+
+#Object thinning the stream of sites passing the filters (in input order) for one configuration
+#With options.loci = (starts, ends) from aln_file_tools.parseLoci, keeps one random site
+#per locus (sites outside every locus are each their own locus); then with options.maxSites,
+#keeps a random subset of at most that many sites, in a reservoir of maxSites sites
+#Each site gets a random key from (options.seed, site index), and the sites with the
+#smallest keys are kept, so the result doesn't depend on how the stream is split into blocks
+class SiteThinner():
+	def __init__(self, options, loci=None, label=None, metrics=None):
+		self.seed = options.seed
+		self.maxSites = options.maxSites
+		self.loci = loci
+		self.prefix = "" if label is None else label + ":"
+		self.metrics = metrics
+		self.pending = None #(group, keys, sites, counts) of the last locus seen
+		self.reservoir = None #(keys, sites, counts) of the kept sites
+		self.removed = 0 #number of sites removed
+
+	#Takes the next block of (sites, (pops x 6 x sites) counts); returns (sites, counts) that
+	#can be passed on now, or None
+	def add(self, sites, counts):
+		keys = seq.siteUniforms(self.seed, THIN_STREAM, sites, 1)[0]
+		if self.loci is not None:
+			keys, sites, counts = self._perLocus(keys, sites, counts)
+		if self.maxSites is None:
+			return((sites, counts))
+		self._reserve(keys, sites, counts)
+		return(None)
+
+	#Returns the remaining (sites, counts) at the end of the stream, or None
+	def finish(self):
+		if self.pending is not None:
+			group, keys, sites, counts = self.pending
+			self.pending = None
+			if self.maxSites is None:
+				return((sites, counts))
+			self._reserve(keys, sites, counts)
+		if self.reservoir is None:
+			return(None)
+		keys, sites, counts = self.reservoir
+		self.reservoir = None
+		order = np.argsort(sites)
+		return((sites[order], counts[:,:,order]))
+
+	#Keeps the site with the smallest key in each locus; holds back the last locus of the
+	#block, which may continue into the next block
+	def _perLocus(self, keys, sites, counts):
+		starts, ends = self.loci
+		k = np.searchsorted(starts, sites, side="right") - 1
+		inLocus = (k >= 0) & (sites < ends[np.maximum(k, 0)])
+		#sites of a locus share its first column; other sites keep their own index
+		groups = np.where(inLocus, starts[np.maximum(k, 0)], sites)
+		if self.pending is not None:
+			groups = np.concatenate((self.pending[0], groups))
+			keys = np.concatenate((self.pending[1], keys))
+			sites = np.concatenate((self.pending[2], sites))
+			counts = np.concatenate((self.pending[3], counts), axis=2)
+		order = np.lexsort((keys, groups))
+		first = order[np.flatnonzero(np.diff(groups[order], prepend=-1) != 0)]
+		last = first[-1:]
+		first = first[:-1]
+		self.pending = (groups[last], keys[last], sites[last], counts[:,:,last]) if len(last) else None
+		self.removed += len(sites) - len(first) - len(last)
+		metrics_tools.count(self.metrics, self.prefix + "removed_locus", len(sites) - len(first) - len(last))
+		return(keys[first], sites[first], counts[:,:,first])
+
+	#Adds sites to the reservoir, keeping the maxSites with the smallest keys
+	def _reserve(self, keys, sites, counts):
+		if self.reservoir is not None:
+			keys = np.concatenate((self.reservoir[0], keys))
+			sites = np.concatenate((self.reservoir[1], sites))
+			counts = np.concatenate((self.reservoir[2], counts), axis=2)
+		if len(keys) > self.maxSites:
+			keep = np.lexsort((sites, keys))[:self.maxSites]
+			self.removed += len(keys) - self.maxSites
+			metrics_tools.count(self.metrics, self.prefix + "removed_max_sites", len(keys) - self.maxSites)
+			keys, sites, counts = keys[keep], sites[keep], counts[:,:,keep]
+		self.reservoir = (keys, sites, counts)
+
+#Function to compute the per-population allele counts of every site (or biallelic SNP
+#record, for a VcfReader; or only the columns in options.sites and options.regions) and
+#save them as a count summary file, which load can then read (as "summary") in place of
+#the input. No filters are applied
+#Returns number of sites written
+def summarize(seqs, popIndex, path, options, metrics=None, pool=None):
+	rows = np.concatenate(list(popIndex.values()))
+	sizes = [len(idx) for idx in popIndex.values()]
+	block = blockSites(options, len(rows))
+	writer = aln.SummaryWriter(path, list(popIndex), sizes, seq.countDtype(sizes))
+	shared = seqs
+	try:
+		if isinstance(seqs, vcf.VcfReader):
+			for sites, counts, popMissing in seqs.iterBlocks(rows, sizes, block):
+				writer.append(counts, sites)
+			writer.close(seqs.nrecords, seqs.nsnps)
+		else:
+			spans = blockSpans(seqs.getSeqLen(), block, siteRanges(options, seqs.getSeqLen()))
+			alen = sum(end-start for start, end in spans)
+			if pool is not None:
+				if isinstance(seqs, aln.Alignment):
+					shared = aln.memmapAlignment(seqs)
+				tasks = [(shared, start, end, rows, sizes, metrics is not None) for start, end in spans]
+				results = mergeMetrics(pool.imap(summaryTask, tasks), metrics)
+			else:
+				results = (summaryBlock(seqs, start, end, rows, sizes, metrics) for start, end in spans)
+			for (start, end), counts in zip(spans, results):
+				writer.append(counts, np.arange(start, end))
+			writer.close(alen)
+	except:
+		writer.abort()
+		raise
+	finally:
+		if shared is not seqs:
+			shared.close()
+	return(writer.header["nsites"])
+
+#Function to read columns [start, end) of the given rows, and count alleles per population
+#Raises ValueError for invalid characters
+def summaryBlock(seqs, start, end, rows, sizes, metrics=None):
+	masks = readMasks(seqs, start, end, rows, metrics, "summarize")
+	with metrics_tools.stage(metrics, "summarize"):
+		return(seq.countAlleles(masks, sizes))
+
+#Function to plan the shared work of filterBatch
+#Returns (rows to read, in order of first use; list of groups of configurations using the
+#same samples), where each group is (positions of its rows in the rows read, or None if
+#all of them in order; pop sizes; keepG; list of (configuration number, pops, options, label))
+def batchLayout(configs):
+	allRows = list()
+	position = dict()
+	groups = collections.OrderedDict()
+	for i, config in enumerate(configs):
+		popIndex, options = config[0:2]
+		label = config[2] if len(config) > 2 else None
+		rows = np.concatenate(list(popIndex.values())).astype(np.intp)
+		for row in rows:
+			if row not in position:
+				position[row] = len(allRows)
+				allRows.append(row)
+		sizes = tuple(len(idx) for idx in popIndex.values())
+		key = (tuple(rows), sizes, options.keepG)
+		groups.setdefault(key, list()).append((i, list(popIndex), options, label))
+	layout = list()
+	for (rows, sizes, keepG), members in groups.items():
+		positions = np.array([position[row] for row in rows], dtype=np.intp)
+		if len(positions) == len(allRows) and (positions == np.arange(len(allRows))).all():
+			positions = None
+		layout.append((positions, list(sizes), keepG, members))
+	return(np.array(allRows, dtype=np.intp), layout)
+
+#Function to sample options.sample alleles per population at every filtered site
+#seed = random seed (default options.seed); a given seed gives the same sample regardless of
+#block size or pool. Returns Markers of sampled characters (A, C, G, T, N, -)
+def sample(filtered, options, seed=None, metrics=None, pool=None):
+	if seed is None:
+		seed = options.seed
+	store = aln.BlockStore(len(filtered.pops)*options.sample, inMemory=not options.chunkSites)
+	tasks = ((counts, sites, filtered.pops, options, seed, metrics is not None) for counts, sites in filtered.iterBlocks())
+	if pool is not None:
+		blocks = mergeMetrics(pool.imap(sampleTask, tasks), metrics)
+	else:
+		blocks = (sampleBlock(counts, sites, pops, options, seed, metrics) for counts, sites, pops, options, seed, keep in tasks)
+	for sampled in blocks:
+		store.append(sampled)
+	return(Markers(store, outputAssign(filtered.pops, options.sample)))
+
+#Function to convert sampled markers to numeric format (0=major, 1=minor, ?=N, -=gap),
+#removing sites that became monomorphic by sampling (unless options.allowM)
+#Returns Markers of encoded columns
+def encode(sampled, options, metrics=None, pool=None):
+	store = aln.BlockStore(len(sampled.names), inMemory=not options.chunkSites)
+	tasks = ((block, options, metrics is not None) for block in sampled.iterBlocks())
+	if pool is not None:
+		blocks = mergeMetrics(pool.imap(encodeTask, tasks), metrics)
+	else:
+		blocks = (encodeBlock(block, options, metrics) for block, options, keep in tasks)
+	for encoded in blocks:
+		store.append(encoded)
+	return(Markers(store, sampled.assign))
+
+#Function to write encoded markers in each of formats (see aln_file_tools.OUTPUT_FORMATS),
+#in one pass over the encoded matrix; NEXUS (with the MLE_BiMarkers skeleton command) is
+#written to out, and other formats next to it (see aln_file_tools.outputPaths)
+#Returns number of columns written
+def write(encoded, out, metrics=None, formats=("nexus",)):
+	nchar = encoded.getSeqLen()
+	with metrics_tools.stage(metrics, "write", nchar):
+		aln.writeMatrix(aln.openWriters(out, formats), encoded.names, encoded.store, encoded.assign)
+	return(nchar)
+
+#Function returns output rows pop_0..pop_(n-1) for each pop, as a dict of row name -> pop
+def outputAssign(pops, n):
+	ret = collections.OrderedDict()
+	for pop in pops:
+		for i in range(0,n):
+			name=pop + "_" + str(i)
+			ret[name] = pop
+	return(ret)
+
+#Function to sample, encode and write one replicate; takes a single tuple of arguments
+#(seed, output file, Filtered, options, keep metrics), so it can be mapped over a pool
+#Stage metrics are added to metrics (a new RunMetrics if None and keep metrics is True)
+#Returns (output file, number of columns written, metrics)
+def runReplicate(task, pool=None, metrics=None):
+	seed, out, filtered, options, keepMetrics = task
+	if metrics is None and keepMetrics:
+		metrics = metrics_tools.RunMetrics()
+	sampled = sample(filtered, options, seed, metrics, pool)
+	encoded = encode(sampled, options, metrics, pool)
+	sampled.close()
+	nchar = write(encoded, out, metrics, options.formats)
+	encoded.close()
+	return(out, nchar, metrics)
+
+#Function to apply the biallelic, globalN and popN filters to one block of columns, for
+#every configuration in a batchLayout
+#masks = (samples x sites) 4-bit masks of the rows read (see readMasks)
+#Raises ValueError if any pop has too few alleles to sample at a passing column
+#Returns list of (indices of passing columns within the block, (pops x 6 x kept) allele counts)
+#for each configuration
+def filterBlock(masks, layout, nconfigs, metrics=None):
+	nsites = masks.shape[1]
+	ret = [None]*nconfigs
+	for positions, sizes, keepG, members in layout:
+		with metrics_tools.stage(metrics, "global_filter"):
+			groupMasks = masks if positions is None else masks[positions]
+			biallelic = (seq.countStates(groupMasks) == 2)
+			missing = seq.countMissing(groupMasks, keepG)
+		with metrics_tools.stage(metrics, "pop_filter", nsites):
+			popMissing = seq.countPopMissing(groupMasks, sizes, keepG)
+			kept = list()
+			for i, pops, params, label in members:
+				passing = biallelic & ~seq.tooMissing(missing, sum(sizes), params.globalN)
+				popPassing = passing.copy()
+				for k, size in enumerate(sizes):
+					popPassing &= ~seq.tooMissing(popMissing[k], size, params.popN)
+				kept.append(np.flatnonzero(popPassing))
+				countRemoved(metrics, label, nsites, biallelic, passing, kept[-1])
+
+			#allele counts for every site kept by any configuration in the group
+			union = kept[0] if len(kept) == 1 else np.unique(np.concatenate(kept))
+			counts = seq.countAlleles(groupMasks[:,union], sizes)
+			for (i, pops, params, label), k in zip(members, kept):
+				ret[i] = (k, counts if len(kept) == 1 else counts[:,:,np.searchsorted(union, k)])
+				checkSampleable(ret[i][1], pops, params)
+	return(ret)
+
+#Function to add the sites removed by each filter to the metrics counters
+def countRemoved(metrics, label, nsites, biallelic, passing, kept):
+	prefix = "" if label is None else label + ":"
+	metrics_tools.count(metrics, prefix + "removed_non_biallelic", nsites - np.count_nonzero(biallelic))
+	metrics_tools.count(metrics, prefix + "removed_maxN", np.count_nonzero(biallelic) - np.count_nonzero(passing))
+	metrics_tools.count(metrics, prefix + "removed_popN", np.count_nonzero(passing) - len(kept))
+
+#Function to read columns [start, end) of the given rows and filter them (see filterBlock)
+def readFilterBlock(seqs, start, end, rows, layout, nconfigs, metrics=None):
+	return(filterBlock(readMasks(seqs, start, end, rows, metrics), layout, nconfigs, metrics))
+
+#Function to read columns [start, end) of the given rows as 4-bit masks
+#A PackedAlignment is unpacked (as part of the given stage) rather than read as characters
+#Raises ValueError for invalid characters
+def readMasks(seqs, start, end, rows, metrics=None, stage="global_filter"):
+	if isinstance(seqs, aln.PackedAlignment):
+		with metrics_tools.stage(metrics, stage, end-start):
+			return(seqs.readMasks(start, end, rows))
+	with metrics_tools.stage(metrics, "parse", end-start):
+		chars = seqs.readBlock(start, end, rows)
+	with metrics_tools.stage(metrics, stage, end-start):
+		return(seq.nucMasks(chars))
+
+#Generator applying the biallelic, globalN and popN filters to blocks of VCF records, for
+#every configuration in a batchLayout
+#Genotypes go straight to allele counts (no IUPAC characters); missing genotypes count as N
+#Yields list of (record index of passing sites, (pops x 6 x kept) allele counts) for each configuration
+def filterVcf(reader, rows, layout, nconfigs, block, metrics=None):
+	blocks = reader.iterGenotypes(rows, block)
+	while True:
+		records = reader.nrecords
+		with metrics_tools.stage(metrics, "parse"):
+			sites, refs, alts, dosage = next(blocks, (None, None, None, None))
+		skipped = reader.nrecords - records - (0 if sites is None else len(sites))
+		for positions, sizes, keepG, members in layout:
+			for i, pops, params, label in members:
+				metrics_tools.count(metrics, ("" if label is None else label + ":") + "removed_non_biallelic", skipped)
+		if sites is None:
+			break
+		ret = [None]*nconfigs
+		for positions, sizes, keepG, members in layout:
+			with metrics_tools.stage(metrics, "global_filter", len(sites)):
+				counts, popMissing = vcf.genotypeCounts(dosage if positions is None else dosage[positions], refs, alts, sizes)
+				#REF/ALT are both observed in the selected samples only if neither count is zero
+				states = np.count_nonzero(counts[:,0:4,:].sum(axis=0), axis=0)
+				biallelic = (states == 2)
+				missing = popMissing.sum(axis=0)
+			with metrics_tools.stage(metrics, "pop_filter", len(sites)):
+				for i, pops, params, label in members:
+					passing = biallelic & ~seq.tooMissing(missing, sum(sizes), params.globalN)
+					kept = np.flatnonzero(seq.filterSites(states, popMissing, sizes, params.globalN, params.popN))
+					countRemoved(metrics, label, len(sites), biallelic, passing, kept)
+					ret[i] = (sites[kept], counts[:,:,kept])
+					checkSampleable(ret[i][1], pops, params)
+		yield(ret)
+
+#Generator applying the biallelic, globalN and popN filters to blocks of a CountSummary,
+#for every configuration in a batchLayout (whose rows are the summary's whole populations)
+#Missing data per population is half its N (and gap, unless keepG) allele count
+#Yields list of (input index of passing sites, (pops x 6 x kept) allele counts) for each configuration
+def filterSummary(summary, layout, nconfigs, block, metrics=None):
+	alen = summary.getSeqLen()
+	for start in range(0, alen, block):
+		end = min(start+block, alen)
+		with metrics_tools.stage(metrics, "parse", end-start):
+			allCounts, sites = summary.readBlock(start, end)
+		ret = [None]*nconfigs
+		for positions, sizes, keepG, members in layout:
+			with metrics_tools.stage(metrics, "global_filter", end-start):
+				counts = allCounts[[summary.index[pop] for pop in members[0][1]]]
+				states = np.count_nonzero(counts[:,0:4,:].sum(axis=0), axis=0)
+				biallelic = (states == 2)
+				popMissing = counts[:,seq.STATE_N,:].astype(np.int32)
+				if not keepG:
+					popMissing += counts[:,seq.STATE_GAP,:]
+				popMissing //= 2
+				missing = popMissing.sum(axis=0)
+			with metrics_tools.stage(metrics, "pop_filter", end-start):
+				for i, pops, params, label in members:
+					passing = biallelic & ~seq.tooMissing(missing, sum(sizes), params.globalN)
+					kept = np.flatnonzero(seq.filterSites(states, popMissing, sizes, params.globalN, params.popN))
+					countRemoved(metrics, label, end-start, biallelic, passing, kept)
+					ret[i] = (sites[kept], counts[:,:,kept])
+					checkSampleable(ret[i][1], pops, params)
+		yield(ret)
+
+#Function raises ValueError if any pop has too few alleles to sample at any site
+#counts = (pops x 6 x sites) allele counts
+def checkSampleable(counts, pops, params):
+	for k, pop in enumerate(pops):
+		if (seq.countSampleable(counts[k], params.allowN, params.allowG) < params.sample).any():
+			raise ValueError("Uh oh! Not enough valid alleles in pop " + str(pop) + " ! Unfortunately, my developer was too lazy to write better error checking! More stringeng --maxN and --popN filtering, or sample less alleles!!")
+
+#Function to sample alleles for a block of sites
+#counts = (pops x 6 x sites) allele counts; sites = alignment index of each site
+#Returns (pops*sample) x sites block of sampled characters
+def sampleBlock(counts, sites, pops, params, seed, metrics=None):
+	#Sample alleles for every site of a pop at once
+	with metrics_tools.stage(metrics, "sample", len(sites)):
+		sampledMat = np.empty((len(pops)*params.sample, len(sites)), dtype=np.uint8)
+		row = 0
+		for k, pop in enumerate(pops):
+			#sample alleles at random, without replacement
+			#(filterBlock already checked there are enough alleles at every site)
+			sampledMat[row:row+params.sample] = seq.sampleAlleleCounts(counts[k], params.sample,
+				params.allowN, params.allowG, seed, seq.popStream(pop), sites)
+			row += params.sample
+	return(sampledMat)
+
+#Function to convert a block of sampled characters to numeric format,
+#applying the monomorphic filter (unless params.allowM), in one pass over the block
+#Returns encoded rows x kept sites block
+def encodeBlock(sampledMat, params, metrics=None):
+	with metrics_tools.stage(metrics, "encode", sampledMat.shape[1]):
+		formattedMat, keep = seq.encodeNumeric(sampledMat, params.allowM)
+	if not params.allowM:
+		metrics_tools.count(metrics, "removed_monomorphic", len(keep) - np.count_nonzero(keep))
+	return(formattedMat)
+
+#Generator passing on the results of pool tasks returning (result, metrics),
+#merging each task's metrics into metrics
+def mergeMetrics(results, metrics):
+	for result, taskMetrics in results:
+		if metrics is not None:
+			metrics.merge(taskMetrics)
+		yield(result)
+
+#Returns a new RunMetrics for a pool task if keep, else None
+def _taskMetrics(keep):
+	if keep:
+		return(metrics_tools.RunMetrics())
+	return(None)
+
+#Pool task: reads and filters the columns [start, end); takes a single tuple of arguments
+#Returns (filterBlock result, metrics of the task)
+def filterTask(task):
+	seqs, start, end, rows, layout, nconfigs, keep = task
+	metrics = _taskMetrics(keep)
+	return(readFilterBlock(seqs, start, end, rows, layout, nconfigs, metrics), metrics)
+
+#Pool task: reads and counts alleles in the columns [start, end); takes a single tuple of arguments
+#Returns (summaryBlock result, metrics of the task)
+def summaryTask(task):
+	seqs, start, end, rows, sizes, keep = task
+	metrics = _taskMetrics(keep)
+	return(summaryBlock(seqs, start, end, rows, sizes, metrics), metrics)
+
+#Pool task: samples one block of sites; takes a single tuple of arguments
+#Returns (sampled block, metrics of the task)
+def sampleTask(task):
+	counts, sites, pops, params, seed, keep = task
+	metrics = _taskMetrics(keep)
+	return(sampleBlock(counts, sites, pops, params, seed, metrics), metrics)
+
+#Pool task: encodes one block of sampled sites; takes a single tuple of arguments
+#Returns (encoded block, metrics of the task)
+def encodeTask(task):
+	block, params, keep = task
+	metrics = _taskMetrics(keep)
+	return(encodeBlock(block, params, metrics), metrics)
@@ -8,7 +8,13 @@ import operator
 import random
 import aln_file_tools as aln
 import seq_tools as seq
+import vcf_tools as vcf
+import metrics_tools
+import pipeline
 import collections
+import multiprocessing
+import json
+import time
 
 """NOTE: When writing this, I prioritized speed of writing the code (e.g. minimizing time
 to getting the input file I wanted), and so it is very inefficient and does not
@@ -17,210 +23,243 @@ implement robust error handling. Sorry. -TKC"""
 def main():
 	params = parseArgs()
 
-	seqs = dict()
-	if params.phylip:
-		print("Parsing phylip file...")
-		#Get sequences as dict of lists
-		seqs = aln.readPhylip(params.phylip)
-	elif params.fasta:
-		print("Parsing fasta file...")
-		seqs = aln.readFastaAlign(params.fasta)
-	else:
-		print("No input provided.")
+	#With --metrics or --profile, time and count each stage of the run
+	metrics = None
+	if params.metrics or params.profile:
+		metrics = metrics_tools.RunMetrics(profile=bool(params.profile))
+	runStart = time.perf_counter()
+
+	#Each configuration to run: one from the command line, or one per line of a --batch manifest
+	if params.batch:
+		print("Reading batch manifest...")
+		try:
+			configs = pipeline.parseManifest(params.batch, params, params.popmap, not params.summary)
+		except ValueError as err:
+			print(err)
+			sys.exit(1)
+		print("Found",len(configs),"configurations in",params.batch)
+		try:
+			outputFiles(configs, params.replicates, params.formats)
+		except ValueError as err:
+			print(err)
+			sys.exit(1)
+	elif not params.popmap and not params.summary:
+		print("ERROR: Popmap file must be provided.")
 		sys.exit(1)
+	else:
+		configs = [pipeline.BatchConfig(params.out, params.popmap, params, params.include, params.exclude)]
 
-	pop_assign = dict()
-	#parse popmap file for dictionary of sample assignments
-	if params.popmap:
+	#parse popmap file(s) first, so that only samples in a selected population are read
+	popmaps = dict()
+	samples = None
+	if params.summary:
+		print("Populations were assigned when the summary was written; ignoring any popmap.")
+	else:
 		print("Parsing popmap file...")
-		pop_assign = aln.parsePopmap(params.popmap)
+		samples = set()
+		with metrics_tools.stage(metrics, "popmap"):
+			for config in configs:
+				if config.popmap not in popmaps:
+					popmaps[config.popmap] = aln.parsePopmap(config.popmap)
+				try:
+					samples |= pipeline.selectSamples(popmaps[config.popmap], config.include, config.exclude)
+				except ValueError as err:
+					if params.batch:
+						print(config.out + ":", err)
+					else:
+						print(err)
+					sys.exit(1)
+	if params.exclude and not params.batch:
+		print("Excluding populations:", ", ".join(params.exclude))
+	if params.include and not params.batch:
+		print("Only keeping populations:", ", ".join(params.include))
+
+	seqs = None
+	if params.vcf:
+		#VCF records are streamed; only biallelic SNP genotypes are read, straight into allele counts
+		print("Reading VCF header...")
+		seqs = pipeline.load(params.vcf, "vcf", params, metrics)
+	elif params.phylip or params.fasta:
+		path, fmt = (params.phylip, "phylip") if params.phylip else (params.fasta, "fasta")
+		if params.cache:
+			#Load binary cache of the alignment (memory-mapped), parsing and caching it if needed
+			print("Loading alignment...")
+		elif not aln.compression(path) and (params.phylip or params.chunkSites):
+			#Only index the file; blocks of columns are read as they are processed
+			print("Indexing",fmt,"file...")
+		elif not aln.compression(path) and (params.sites or params.regions):
+			#Only the selected columns are read, if the line width is constant (otherwise it is parsed)
+			print("Indexing",fmt,"file (parsing it if its line width is not constant)...")
+		else:
+			#Compressed input (or FASTA without --chunk-sites) is decompressed and parsed into memory
+			if params.chunkSites:
+				print("Note: compressed input is loaded into memory. Use --cache to stream it in later runs.")
+			print("Parsing",fmt,"file...")
+		if params.packed:
+			#Alignment is held as 4-bit masks, two sites per byte
+			print("Packing alignment into memory...")
+		try:
+			seqs = pipeline.load(path, fmt, params, metrics, samples)
+		except (ValueError, OSError) as err:
+			print(err)
+			sys.exit(1)
+		cache = getattr(seqs, "cache", None)
+		if cache is not None:
+			print("Wrote alignment cache" if cache[1] else "Loaded alignment cache",cache[0])
+		if seqs.skipped[0]:
+			print("Skipped",seqs.skipped[0],"unselected samples (" + str(seqs.skipped[1]),"bytes of sequence)")
+	elif params.summary:
+		#Per-population allele counts saved by --write-summary; populations are already assigned
+		print("Loading allele count summary...")
+		seqs = pipeline.load(params.summary, "summary", params, metrics)
 	else:
-		print("ERROR: Popmap file must be provided.")
+		print("No input provided.")
 		sys.exit(1)
 
-	if seqs and pop_assign:
-
-		#Remove samples from pop_assign that do not have data
-		pop_assign = aln.cleanPopmap(pop_assign, seqs.keys())
-
-		#Make dict of dicts that splits by population, only retaining pops/samples from the popmap.
-		#Get unique pop names using one of the worst python lines ever written
-		pops = dict()
-		for k in set(pop_assign.values()):
-			pops[k] = dict()
-
-		#Remove pops listed as excluded
-		if params.exclude:
-			print("Excluding populations:", ", ".join(params.exclude))
-			for exc in params.exclude:
-				if exc in pops:
-					del pops[exc]
-		if params.include:
-			print("Only keeping populations:", ", ".join(params.include))
-			for pop in list(pops):
-				if pop not in params.include:
-					del pops[pop]
-
-		#make sure we didn't throw out all populations...
-		if len(list(pops)) < 1:
-			print("Oops! No populations remaining. Check that popmap sample names match those in your data file, or that selections using --include or --exclude are correct! :)")
+	#group samples by population, keeping only pops that are selected
+	#Note that this removes samples for which we have data but no pop assignment
+	selected = list()
+	for config in configs:
+		try:
+			popIndex = pipeline.selectPops(seqs, popmaps.get(config.popmap), config.include, config.exclude, metrics)
+		except ValueError as err:
+			if params.batch:
+				print(config.out + ":", err)
+			else:
+				print(err)
 			sys.exit(1)
-
-		#Capture samples for each pop in a dict of dicts
-		#Note that this removes samples for which we have data but no pop assignment
-		alen = seq.getSeqLen(seqs)
-		for assigned in pop_assign:
-			if pop_assign[assigned] in pops:
-				pops[pop_assign[assigned]][assigned] = seqs[assigned]
-		seqs.clear()
-		#debugging print
-		# for pop in pops.keys():
-		# 	print("\n",pop)
-		# 	for ind in pops[pop]:
-		# 		print(ind, len(pops[pop][ind]), "nucleotides")
-
-		#Make 2D list to remove columns failing the globalN filter
-		bad_columns = list() #list of column numbers to delete
-
-		#For each pop dict, make 2D list to remove columns failing popN filter
-		print("Found",alen,"nucleotide columns in the dataset!")
-		columns = [[]for i in range(alen)] #2D array of global data
-		for pop, data in pops.items():
-			for sample, sequence in data.items():
-				for i, nuc in enumerate(sequence):
-					columns[i].append(nuc)
-
-		#Remove columns with >globalN ambiguous bases, or those which are non-biallelic
-		print("Removing non-biallelic columns...")
-		if not params.keepG:
-			print("Checking N content (counting gaps as missing data)...")
+		selected.append((popIndex, config.options, config.out if params.batch else None))
+
+	#With --threads, blocks are summarized, filtered, sampled and encoded by a pool of worker processes
+	pool = None
+	if params.threads > 1:
+		print("Using",params.threads,"processes...")
+		pool = multiprocessing.Pool(params.threads)
+
+	#With --write-summary, count alleles per population at every site, save the counts, and
+	#continue from the saved summary (later runs can start from it with --summary)
+	if params.writeSummary:
+		print("Writing allele count summary to",params.writeSummary,"...")
+		try:
+			nsites = pipeline.summarize(seqs, selected[0][0], params.writeSummary, params, metrics, pool)
+		except ValueError as err:
+			print(err)
+			if pool is not None:
+				pool.terminate()
+			sys.exit(1)
+		seqs.close()
+		print("Wrote allele counts for",nsites,"sites")
+		seqs = pipeline.load(params.writeSummary, "summary", params, metrics)
+		selected = [(pipeline.selectPops(seqs, None, metrics=metrics), params, None)]
+
+	if isinstance(seqs, aln.CountSummary):
+		print("Found",seqs.getSeqLen(),"summarized sites (of",seqs.inputSites,"input columns/records) in the dataset!")
+	elif not isinstance(seqs, vcf.VcfReader):
+		print("Found",seqs.getSeqLen(),"nucleotide columns in the dataset!")
+
+	#Remove columns with >globalN ambiguous bases, those with >popN ambiguous bases
+	#within any population, or those which are non-biallelic. This is done one block of
+	#columns at a time, keeping only per-population allele counts for passing columns
+	#With --batch, each block is read once and statistics are shared between configurations
+	print("Removing non-biallelic columns...")
+	if isinstance(seqs, vcf.VcfReader) or (isinstance(seqs, aln.CountSummary) and seqs.inputSnps is not None):
+		print("Checking N content (counting missing genotypes as missing data)...")
+	elif not params.keepG:
+		print("Checking N content (counting gaps as missing data)...")
+	else:
+		print("Checking N content (NOT counting gaps as missing data)...")
+	if params.chunkSites:
+		print("Streaming",params.chunkSites,"columns at a time...")
+	if params.sites or params.regions:
+		print("Only reading the selected column ranges...")
+	if params.loci:
+		print("Keeping one random site per locus in",params.loci,"...")
+	if params.maxSites:
+		print("Randomly keeping at most",params.maxSites,"sites (before the monomorphic check)...")
+
+	try:
+		filtered = pipeline.filterBatch(seqs, selected, metrics, pool)
+	except ValueError as err:
+		print(err)
+		if pool is not None:
+			pool.terminate()
+		seqs.close()
+		sys.exit(1)
+	seqs.close()
+	if filtered[0].nsnps is not None:
+		print("Read",filtered[0].nsites,"VCF records, of which",filtered[0].nsnps,"were biallelic SNPs!")
+	if params.batch:
+		for config, result in zip(configs, filtered):
+			print(config.out + ": deleted",result.nsites-result.getSeqLen()-result.thinned,"columns" +
+				(", then thinned " + str(result.thinned) + " passing sites" if result.thinned else ""))
+	else:
+		print("Deleted",filtered[0].nsites-filtered[0].getSeqLen()-filtered[0].thinned,"columns!")
+		if params.loci or params.maxSites:
+			print("Thinned",filtered[0].thinned,"passing sites, keeping",filtered[0].getSeqLen(),"sites")
+
+	#Finally, sample alleles from pops, convert to numeric format, and write output
+	#With --replicates or --batch, each output is sampled independently (in a pool of processes)
+	#Otherwise, with --threads, blocks of sites are sampled and encoded in parallel
+	if not params.allowM:
+		print("Now applying a final check for monomorphic loci...")
+	tasks = list()
+	for config, result in zip(configs, filtered):
+		for rep in range(params.replicates):
+			if params.replicates == 1:
+				out = config.out
+			else:
+				out = replicateName(config.out, rep)
+			tasks.append((seq.replicateSeed(config.options.seed, rep), out, result, config.options, metrics is not None))
+	written = list()
+	#Output files that can't be written raise OSError (also from worker processes)
+	try:
+		if len(tasks) == 1:
+			print("Sampling alleles (random seed = " + str(params.seed) + ")...")
+			print("Converting to numeric format...")
+			print("Writing " + ", ".join(aln.outputPaths(tasks[0][1], params.formats).values()) + "...")
+			out, nchar, repMetrics = pipeline.runReplicate(tasks[0], pool, metrics)
+			written.append(nchar)
 		else:
-			print("Checking N content (NOT counting gaps as missing data)...")
-		for i, col in enumerate(columns):
-			if not seq.isBiallelic(col):
-				bad_columns.append(i)
-			if not params.keepG:
-				if seq.checkNGcontent(col, params.globalN): #counts gaps as Ns
-					bad_columns.append(i)
+			if params.batch:
+				print("Sampling",len(tasks),"outputs...")
 			else:
-				if seq.checkNcontent(col, params.globalN): #counts gaps as Ns
-					bad_columns.append(i)
-		bad_columns=sorted(set(bad_columns))
-		columns.clear()
-
-		#Now get bad columns WITHIN pops for localN failing sites
-			#New 2D structure: dict of pops, each pop a list of lists.
-			#Lists in each pop are COLUMNS of nucleotide data
-			#From here on, we don't track which alleles belong to which individual
-			#the end product will be alleles sampled at random from each population
-		popFinal = dict()
-		for pop, data in pops.items():
-			columns = [[]for i in range(alen)]
-			for sample, sequence in data.items():
-				for i, nuc in enumerate(sequence):
-					columns[i].append(nuc)
-			for i, col in enumerate(columns):
-				if not params.keepG:
-					if seq.checkNGcontent(col, params.globalN): #counts gaps as Ns
-						bad_columns.append(i)
-				else:
-					if seq.checkNcontent(col, params.globalN): #counts gaps as Ns
-						bad_columns.append(i)
-			popFinal[pop] = columns
-		#Re-sort and unique the bad_columns list
-		bad_columns=sorted(set(bad_columns))
-		print("Deleting",len(bad_columns),"columns!")
-		#For each pop, remove blacklisted columns
-		for pop in popFinal:
-			for col in sorted(bad_columns,reverse=True): #reverse sorted so subsequent deletes aren't thrown off
-				#print(col,":",columns[col])
-				del popFinal[pop][col]
-
-		#Finally, sample alleles from pops.
-		outputFinal = collections.OrderedDict()
-		outputAssign = collections.OrderedDict()
-		for pop in popFinal:
-			for i in range(0,params.sample):
-				name=pop + "_" + str(i)
-				outputAssign[name] = pop
-				outputFinal[name] = list()
-			#print(outputAssign)
-			for nucs in popFinal[pop]:
-				#sample alleles at random, without replacement
-				sampled = seq.sampleAlleles(nucs, params.sample, params.allowN, params.allowG)
-				#check that we sampled enough alleles
-				if len(sampled) < params.sample :
-					print("Uh oh! Not enough valid alleles in pop",pop,"! Unfortunately, my developer was too lazy to write better error checking! More stringeng --maxN and --popN filtering, or sample less alleles!!")
-					sys.exit(1)
-
-				#insert alleles into outputFinal
-				for i in range(0,params.sample):
-					name=pop + "_" + str(i)
-					outputFinal[name].append(sampled[i])
-		popFinal.clear()
-
-		#Convert to numeric format...
-		outputFinal_formatted = collections.OrderedDict()
-		for ind in outputFinal:
-			#print(ind,", Nucs:",outputFinal[ind][0:10])
-			outputFinal_formatted[ind] = list()
-
-		if not params.allowM:
-			print("Now applying a final check for monomorphic loci...")
-		print("Converting to numeric format...")
-		countM = 0
-		for i in range(0,seq.getSeqLen(outputFinal)):
-			this_column = list()
-			for ind in outputFinal:
-				this_column.append(outputFinal[ind][i])
-			if seq.isMonomorphic(this_column):
-				if not params.allowM:
-					continue
-			numeric = seq.nucs2numeric(this_column)
-			k=0
-			for ind in outputFinal:
-				outputFinal_formatted[ind].append(numeric[k])
-				k+=1
-		outputFinal.clear()
-
-		#output alignment to NEXUS
-		#for ind in outputFinal_formatted:
-			#print(ind,", Nucs:",outputFinal_formatted[ind][0:10])
-		aln.dict2nexus(params.out, outputFinal_formatted)
-
-		#Append MLE_BiMarkers skeleton command to NEXUS file
-		print("Writing PHYLONET block to Nexus file...")
-		with open(params.out, 'a') as fh:
-			try:
-				line1 = "BEGIN PHYLONET;\n"
-				fh.write(line1)
-				taxalist = ",".join(list(outputAssign))
-				taxamap = ""
-				popGroup = dict()
-				for sampleID, popID in outputAssign.items():
-					if popID not in popGroup:
-						popGroup[popID] = list()
-					popGroup[popID].append(sampleID)
-				first = True
-				for popID in popGroup.keys():
-					if first:
-						taxamap = popID + ":" + ",".join(popGroup[popID])
-						first = False
-					else:
-						taxamap += ";" + popID + ":" + ",".join(popGroup[popID])
-				#print(taxamap)
-				line2 = "MLE_BiMarkers -taxa (" + taxalist + ") -tm <" + taxamap + ">;\nEND;\n"
-				fh.write(line2)
-			except IOError:
-				print("Could not read file ",params.out)
-				sys.exit(1)
-			finally:
-				fh.close()
-
-
-	else:
-		print("Oops! Something went wrong reading alignment or popmap file! Sorry this error message isn't more informative! >:)")
+				print("Sampling",params.replicates,"replicates (random seed = " + str(params.seed) + ")...")
+			if pool is None:
+				pool = multiprocessing.Pool(min(len(tasks), os.cpu_count() or 1))
+			for out, nchar, repMetrics in pool.imap(pipeline.runReplicate, tasks):
+				print("Wrote",nchar,"columns to",", ".join(aln.outputPaths(out, params.formats).values()))
+				written.append(nchar)
+				if metrics is not None:
+					metrics.merge(repMetrics)
+	except OSError as err:
+		print("Could not write output:",err)
+		if pool is not None:
+			pool.terminate()
+		for result in filtered:
+			result.close()
 		sys.exit(1)
+	if pool is not None:
+		pool.close()
+		pool.join()
+	for result in filtered:
+		result.close()
+
+	#Report per-stage metrics
+	if metrics is not None:
+		print("Run metrics (times are summed over processes):")
+		metrics.summary()
+		kept = [int(result.getSeqLen()) for result in filtered]
+		sites = collections.OrderedDict((("input", int(filtered[0].nsites)), ("after_filters", kept if params.batch else kept[0]), ("written", written)))
+		if params.metrics:
+			with open(params.metrics, "w") as fh:
+				json.dump(metrics.report(time.perf_counter() - runStart, {"sites":sites}), fh, indent=2)
+				fh.write("\n")
+			print("Wrote run metrics to",params.metrics)
+		if params.profile:
+			name = metrics.dumpProfile(params.profile)
+			if name is not None:
+				print("Wrote cProfile stats for the slowest stage in the main process (" + name + ") to",params.profile)
+				print("(Time spent in worker processes is not profiled.)")
 
 	# #get list of columns and list of samplenames
 	# alen = getSeqLen(seqs)
@@ -267,6 +306,28 @@ def main():
 	# dict2nexus(params.out, final_data)
 
 
+#Function returns the output file name for replicate rep (0-based): out_1.nex, out_2.nex...
+#A trailing .gz is kept at the end (out_1.nex.gz)
+def replicateName(out, rep):
+	gz = ""
+	if out.endswith(".gz"):
+		out, gz = out[:-3], ".gz"
+	root, ext = os.path.splitext(out)
+	return(root + "_" + str(rep+1) + ext + gz)
+
+#Function returns every file written for configs (each replicate, in each of formats)
+#Raises ValueError if two outputs would be written to the same file
+def outputFiles(configs, replicates, formats):
+	ret = dict()
+	for config in configs:
+		for rep in range(replicates):
+			out = config.out if replicates == 1 else replicateName(config.out, rep)
+			for path in aln.outputPaths(out, formats).values():
+				if path in ret:
+					raise ValueError("Outputs %s and %s would both be written to %s"%(ret[path], out, path))
+				ret[path] = out
+	return(list(ret))
+
 #Object to parse command-line arguments
 class parseArgs():
 	def __init__(self):
@@ -274,7 +335,7 @@ class parseArgs():
 		try:
 			options, remainder = getopt.getopt(sys.argv[1:], 'f:i:ho:dp:s:N:n:x:I:agGm', \
 			["input=","phylip=","phy=","out=","nohet","fasta=","popmap=","maxN=",
-			"popN=","exclude=","include=", "allowG", "allowN", "keepG","allowM"])
+			"popN=","exclude=","include=", "allowG", "allowN", "keepG","allowM","seed=","chunk-sites=","cache","cache-dir=","replicates=","threads=","vcf=","metrics=","profile=","batch=","summary=","write-summary=","packed","max-sites=","loci=","sites=","regions=","formats="])
 		except getopt.GetoptError as err:
 			print(err)
 			self.display_help("\nExiting because getopt returned non-zero exit status.")
@@ -282,6 +343,7 @@ class parseArgs():
 		#Input params
 		self.phylip=None
 		self.fasta=None
+		self.vcf=None
 		self.popmap=None
 		self.out="out.nex"
 		self.nohet=False
@@ -290,6 +352,23 @@ class parseArgs():
 		self.popN=0.5
 		self.exclude = list()
 		self.include = list()
+		self.seed=None
+		self.chunkSites=None
+		self.cache=False
+		self.cacheDir=None
+		self.replicates=1
+		self.threads=1
+		self.metrics=None
+		self.profile=None
+		self.batch=None
+		self.summary=None
+		self.writeSummary=None
+		self.packed=False
+		self.maxSites=None
+		self.loci=None
+		self.sites=None
+		self.regions=None
+		self.formats=["nexus"]
 
 		#booleans
 		self.allowN=False
@@ -313,6 +392,8 @@ class parseArgs():
 				self.phylip = arg
 			elif opt in ('f', 'fasta'):
 				self.fasta = arg
+			elif opt == "vcf":
+				self.vcf = arg
 			elif opt in ('p', 'popmap'):
 				self.popmap = arg
 			elif opt in ('h', 'help'):
@@ -339,18 +420,85 @@ class parseArgs():
 				self.keepG=True
 			elif opt in ("m", "allowM"):
 				self.allowM=True
+			elif opt == "seed":
+				self.seed = int(arg)
+			elif opt == "chunksites":
+				self.chunkSites = int(arg)
+			elif opt == "cache":
+				self.cache=True
+			elif opt == "cachedir":
+				self.cache=True
+				self.cacheDir = arg
+			elif opt == "replicates":
+				self.replicates = int(arg)
+			elif opt == "threads":
+				self.threads = int(arg)
+			elif opt == "metrics":
+				self.metrics = arg
+			elif opt == "profile":
+				self.profile = arg
+			elif opt == "batch":
+				self.batch = arg
+			elif opt == "summary":
+				self.summary = arg
+			elif opt == "writesummary":
+				self.writeSummary = arg
+			elif opt == "packed":
+				self.packed=True
+			elif opt == "maxsites":
+				self.maxSites = int(arg)
+			elif opt == "loci":
+				self.loci = arg
+			elif opt == "sites":
+				self.sites = arg
+			elif opt == "regions":
+				self.regions = arg
+			elif opt == "formats":
+				self.formats = [fmt.strip().lower() for fmt in arg.split(",") if fmt.strip()]
 			else:
 				assert False, "Unhandled option %r"%opt
 
 		#Check manditory options are set
-		if not self.phylip and not self.fasta:
-			self.display_help("Error: Missing required alignment file (--fasta or --input)")
-		if not self.popmap:
+		inputs = [opt for opt in (self.phylip, self.fasta, self.vcf, self.summary) if opt]
+		if not inputs:
+			self.display_help("Error: Missing required alignment file (--fasta, --input, --vcf or --summary)")
+		if len(inputs) > 1:
+			self.display_help("Error: Use only one of --fasta, --input, --vcf or --summary.")
+		if self.packed and not (self.phylip or self.fasta):
+			self.display_help("Error: --packed can only be used with an alignment (--fasta or --input).")
+		if self.writeSummary and (self.summary or self.batch):
+			self.display_help("Error: --write-summary can't be used with --summary or --batch.")
+		if not self.popmap and not self.batch and not self.summary:
 			self.display_help("Error: Missing required popmap file (-p, --popmap)")
 		if self.include and self.exclude:
 			self.display_help("Don't use both --include and --exclude.")
 		if self.sample < 1:
 			self.display_help("Error: --sample must be greater than 1.")
+		if self.seed is None:
+			self.seed = random.SystemRandom().getrandbits(32)
+		elif self.seed < 0:
+			self.display_help("Error: --seed must be a positive integer.")
+		if self.threads < 1:
+			self.display_help("Error: --threads must be greater than 0.")
+		if self.replicates < 1:
+			self.display_help("Error: --replicates must be greater than 0.")
+		if self.chunkSites is not None and self.chunkSites < 1:
+			self.display_help("Error: --chunk-sites must be greater than 0.")
+		if self.maxSites is not None and self.maxSites < 1:
+			self.display_help("Error: --max-sites must be greater than 0.")
+		if (self.sites or self.regions) and not (self.phylip or self.fasta):
+			self.display_help("Error: --sites and --regions can only be used with an alignment (--fasta or --input).")
+		if self.regions and not os.path.exists(self.regions):
+			self.display_help("Error: Region file " + self.regions + " not found.")
+		if self.loci and not os.path.exists(self.loci):
+			self.display_help("Error: Locus file " + self.loci + " not found.")
+		unknown = [fmt for fmt in self.formats if fmt not in aln.OUTPUT_FORMATS]
+		if unknown or not self.formats:
+			self.display_help("Error: Unknown --formats " + ",".join(unknown) + " (use " + ",".join(aln.OUTPUT_FORMATS) + ").")
+		try:
+			aln.outputPaths(self.out, self.formats)
+		except ValueError as err:
+			self.display_help("Error: " + str(err))
 
 
 	def display_help(self, message=None):
@@ -367,10 +515,19 @@ class parseArgs():
 		-i,--input	: Input file as PHYLIP
 			-or-
 		-f,--fasta	: optionally input your data as FASTA
+			-or-
+		--vcf		: optionally input SNP genotypes as VCF (only biallelic SNPs are used)
+			-Any of these may be gzip or BGZF (bgzip) compressed
+			-or-
+		--summary	: optionally start from an allele count summary written by --write-summary
+			-Populations were assigned when it was written, so -p is ignored (use -I/-x to select pops)
 		-p,--popmap	: Tab-delimited population map
 
 		PARAMETERS [OPTIONAL]
-		-o,--out	: Output file name <default = out.nex>
+		-o,--out	: Output file name <default = out.nex> (gzip-compressed if it ends in .gz)
+		--formats	: Comma-separated output formats, all written in one pass [default=nexus]
+			-nexus: NEXUS with PHYLONET block (to --out); phylip: numeric PHYLIP (<out>.phy)
+			-snapp: binary NEXUS for SNAPP, gaps as ? (<out>.snapp.nex); binary: int8 NumPy matrix (<out>.npy)
 		-s,--sample	: Number of alleles to sample [default=1]
 		-N,--maxN	: Maximum proportion of globally missing data allowed to drop a SNP [default=0.5]
 		-n,--popN	: Maximum proportion of Ns within pop to drop SNP [default=0.5]
@@ -382,6 +539,41 @@ class parseArgs():
 		-m,--allowM	: Toggle on to allow loci that are monomorphic as a consequence of random sampling
 			-When sampling a small number of alleles, it is possible to lose all variation.
 			-Use this option to turn off the monomorphic filter that is applied AFTER sampling alleles
+		--seed		: Random seed for allele sampling [default=random, printed at runtime]
+		--sites		: Only read and use these alignment columns (1-based, inclusive; e.g. "1-5000,20001-25000")
+		--regions	: Only read and use the column ranges in this BED-like file (may be combined with --sites)
+			-Lines are "start end" or "name start end", 0-based and end-exclusive (as BED)
+			-Only the selected bytes of each row are read from an uncompressed (or cached) alignment
+		--max-sites	: Keep a random subset of at most N of the sites passing -N and -n
+			-Chosen in one pass with a reservoir of N sites; only these are sampled and encoded
+			-Sites made monomorphic by sampling are then removed as usual (unless -m)
+		--loci		: Locus boundary file (e.g. for concatenated RAD loci); keeps one random passing site per locus
+			-One locus per line, ending with its first and last column: "1-85", "loc1 1 85" or "DNA, loc1 = 1-85"
+			-For --vcf, columns are record numbers. Sites outside every locus are kept as their own locus
+		--chunk-sites	: Stream the alignment N columns at a time, rather than loading it all
+			-Peak memory is then bounded by N rather than alignment length
+			-Requires FASTA with a constant line width (PHYLIP must be sequential)
+		--cache		: Toggle on to cache the parsed alignment as a binary file next to the input
+			-Later runs load the cache instead of parsing (rebuilt automatically if the input changes)
+		--cache-dir	: Same as --cache, but keep cache files in this directory
+		--packed	: Toggle on to hold the alignment in memory as 4-bit codes, two sites per byte
+			-Half the memory of a parsed alignment; blocks are unpacked as they are filtered
+			-The input (or cache) is read one block of columns at a time while packing
+		--replicates	: Number of independent replicate samplings to write [default=1]
+			-Alignment is parsed and filtered once; replicates are sampled in parallel
+			-Output files are named <out>_1.nex ... <out>_K.nex
+		--threads	: Number of processes used to filter, sample and encode blocks of columns [default=1]
+			-Output is identical to a single-process run with the same --seed
+			-With --replicates, also sets the number of replicates sampled at once [default=all cores]
+		--batch		: Run every configuration in this tab-delimited manifest against one parsed alignment
+			-Header line names the columns: out (required), popmap, include, exclude, sample, maxN, popN, seed, maxSites, loci
+			-Empty cells take the value given on the command line
+		--write-summary	: Save per-population allele counts of every site to this file, then run from it
+			-Re-run with other -s, -N, -n, -G, --seed ... using --summary, without re-reading the input
+		--metrics	: Write wall/CPU time, peak memory and items processed for each stage to this JSON file
+			-Also records how many sites each filter removed
+		--profile	: Write cProfile stats (pstats format) for the slowest stage in the main process to this file
+			-Only the main process is profiled; time stages spend in worker processes is not counted
 		-h,--help	: Displays help menu
 
 		Note that this script will not sample Ns or gap characters by default. Both are treated as missing data. Filter accordingly.
@@ -4,10 +4,321 @@ import re
 import sys
 import os
 import random
-import operator
+import zlib
+import numpy as np
 
 """Tools for manipulating sequence data by Tyler Chafin"""
 
+#4-bit nucleotide masks used by the vectorized (whole-matrix) functions
+#A=1, C=2, G=4, T=8; ambiguity codes are the OR of their bases
+#N is all four bases (15), gaps are 0
+MASK_A = 1
+MASK_C = 2
+MASK_G = 4
+MASK_T = 8
+MASK_N = 15
+MASK_GAP = 0
+MASK_INVALID = 255
+
+#IUPAC codes, expanded to bases (N is all four bases)
+IUPAC = {
+	"A"	: ["A"],
+	"G"	: ["G"],
+	"C"	: ["C"],
+	"T"	: ["T"],
+	"N"	: ["A", "C", "G", "T"],
+	"-"	: ["-"],
+	"R"	: ["A","G"],
+	"Y"	: ["C","T"],
+	"S"	: ["G","C"],
+	"W"	: ["A","T"],
+	"K"	: ["G","T"],
+	"M"	: ["A","C"],
+	"B"	: ["C","G","T"],
+	"D"	: ["A","G","T"],
+	"H"	: ["A","C","T"],
+	"V"	: ["A","C","G"]
+}
+
+#IUPAC codes, expanded to a diploid genotype (homozygotes, N and gaps are doubled)
+IUPAC_DIPLOID = {
+	"A"	: ["A", "A"],
+	"G"	: ["G", "G"],
+	"C"	: ["C", "C"],
+	"T"	: ["T", "T"],
+	"N"	: ["N", "N"],
+	"-"	: ["-","-"],
+	"R"	: ["A","G"],
+	"Y"	: ["C","T"],
+	"S"	: ["G","C"],
+	"W"	: ["A","T"],
+	"K"	: ["G","T"],
+	"M"	: ["A","C"],
+	"B"	: ["C","G","T"],
+	"D"	: ["A","G","T"],
+	"H"	: ["A","C","T"],
+	"V"	: ["A","C","G"]
+}
+
+#Sorted bases -> IUPAC code (reverse of IUPAC)
+REVERSE_IUPAC = {
+	'A':'A',
+	'N':'N',
+	'-':'-',
+	'C':'C',
+	'G':'G',
+	'T':'T',
+	'AG':'R',
+	'CT':'Y',
+	'AC':'M',
+	'GT':'K',
+	'AT':'W',
+	'CG':'S',
+	'CGT':'B',
+	'AGT':'D',
+	'ACT':'H',
+	'ACG':'V',
+	'ACGT':'N'
+}
+
+#Adds lowercase keys to one of the tables above, so lookups don't need upper()
+def _caseless(table):
+	ret = dict(table)
+	for key, value in table.items():
+		ret[key.lower()] = value
+	return(ret)
+
+_IUPAC = _caseless(IUPAC)
+_IUPAC_DIPLOID = _caseless(IUPAC_DIPLOID)
+_REVERSE_IUPAC = _caseless(REVERSE_IUPAC)
+
+#Lookup table of byte -> 4-bit mask (caseless); invalid characters are MASK_INVALID
+def _buildMaskTable():
+	table = np.full(256, MASK_INVALID, dtype=np.uint8)
+	for char, bases in IUPAC.items():
+		mask = MASK_GAP
+		for base in bases:
+			if base != "-":
+				mask |= {"A":MASK_A, "C":MASK_C, "G":MASK_G, "T":MASK_T}[base]
+		table[ord(char)] = mask
+		table[ord(char.lower())] = mask
+	return(table)
+
+MASK_TABLE = _buildMaskTable()
+
+#Number of bases in each 4-bit mask
+POPCOUNT = np.array([bin(i).count("1") for i in range(16)], dtype=np.uint8)
+
+#Missing data class of each byte: a base (or ambiguity code), N, gap, or invalid
+CLASS_BASE = 0
+CLASS_N = 1
+CLASS_GAP = 2
+CLASS_INVALID = 255
+
+def _buildClassTable():
+	table = np.full(256, CLASS_INVALID, dtype=np.uint8)
+	for char in IUPAC:
+		if char == "N":
+			cls = CLASS_N
+		elif char == "-":
+			cls = CLASS_GAP
+		else:
+			cls = CLASS_BASE
+		table[ord(char)] = cls
+		table[ord(char.lower())] = cls
+	return(table)
+
+CLASS_TABLE = _buildClassTable()
+
+#Lookup table of byte -> diploid allele copies of A, C, G, T, N, gap (as get_iupac_caseless_diploid)
+#Invalid characters are all zero (check with CLASS_TABLE)
+def _buildDiploidTable():
+	table = np.zeros((256, 6), dtype=np.uint8)
+	for char, alleles in IUPAC_DIPLOID.items():
+		for allele in alleles:
+			table[ord(char), "ACGTN-".index(allele)] += 1
+		table[ord(char.lower())] = table[ord(char)]
+	return(table)
+
+DIPLOID_TABLE = _buildDiploidTable()
+
+#Function to convert an array of characters (uint8 ASCII) to 4-bit masks
+#Raises ValueError if any character is not a valid IUPAC code, N, or gap
+def nucMasks(chars):
+	masks = MASK_TABLE[chars]
+	if (masks == MASK_INVALID).any():
+		bad = sorted(set(chr(c) for c in np.unique(chars[masks == MASK_INVALID])))
+		raise ValueError("Invalid character(s) in alignment: %s"%", ".join(bad))
+	return(masks)
+
+#Uppercase character of each 4-bit mask (0 = gap, 15 = N), to decode packed masks
+def _buildMaskChars():
+	table = np.zeros(16, dtype=np.uint8)
+	for char in IUPAC:
+		table[MASK_TABLE[ord(char)]] = ord(char)
+	return(table)
+
+MASK_CHARS = _buildMaskChars()
+
+#Diploid allele copies (see DIPLOID_TABLE) of each 4-bit mask, for countAlleles
+MASK_DIPLOID = DIPLOID_TABLE[MASK_CHARS]
+
+#Function to pack a (samples x sites) mask matrix two sites per byte: site 2j in the low
+#4 bits of byte j, site 2j+1 in the high 4 bits. Returns (samples x ceil(sites/2)) uint8 matrix
+def packMasks(masks):
+	ret = np.array(masks[:,0::2], dtype=np.uint8)
+	high = masks[:,1::2]
+	ret[:,0:high.shape[1]] |= (high << 4).astype(np.uint8)
+	return(ret)
+
+#Function to unpack nsites masks from bytes of packMasks output, starting at the low (offset=0)
+#or high (offset=1) half of the first byte. Returns (samples x nsites) mask matrix
+def unpackMasks(packed, offset, nsites):
+	ret = np.empty((packed.shape[0], packed.shape[1]*2), dtype=np.uint8)
+	np.bitwise_and(packed, 15, out=ret[:,0::2])
+	np.right_shift(packed, 4, out=ret[:,1::2])
+	return(ret[:,offset:offset+nsites])
+
+#Function takes a (samples x sites) mask matrix and returns, per site, the OR of all
+#alleles observed, ignoring gaps and Ns (as isBiallelic and isMonomorphic do)
+def alleleUnion(masks):
+	valid = np.where(masks == MASK_N, np.uint8(0), masks)
+	return(np.bitwise_or.reduce(valid, axis=0))
+
+#Function takes a (samples x sites) mask matrix and returns number of allele states per site
+def countStates(masks):
+	return(POPCOUNT[alleleUnion(masks)])
+
+#Function takes a (samples x sites) mask matrix and returns count of missing genotypes per site
+#Counts N and gaps, or only N if keepG
+def countMissing(masks, keepG=False):
+	missing = (masks == MASK_N)
+	if not keepG:
+		missing |= (masks == MASK_GAP)
+	return(np.count_nonzero(missing, axis=0))
+
+#Function takes per-site missing counts and the number of samples, returns array which is
+#TRUE where missing content is too high (same test as checkNGcontent/checkNcontent)
+def tooMissing(missing, nsamples, threshold):
+	return((missing / nsamples) >= float(threshold))
+
+#Function takes a (samples x sites) mask matrix with rows sorted by population, and the
+#number of samples in each population, and returns a (pops x sites) array of missing counts
+#Counted one population at a time (N and gaps, or only N if keepG)
+def countPopMissing(masks, sizes, keepG=False):
+	ret = np.empty((len(sizes), masks.shape[1]), dtype=np.int32)
+	start = 0
+	for k, size in enumerate(sizes):
+		ret[k] = countMissing(masks[start:start+size], keepG)
+		start += size
+	return(ret)
+
+#Function applies the biallelic, global (--maxN) and per-population (--popN) filters
+#to per-site state counts and (pops x sites) missing counts. Returns boolean array, TRUE for passing sites
+def filterSites(states, popMissing, sizes, globalN, popN):
+	passing = (states == 2)
+	passing &= ~tooMissing(popMissing.sum(axis=0), sum(sizes), globalN)
+	for k, size in enumerate(sizes):
+		passing &= ~tooMissing(popMissing[k], size, popN)
+	return(passing)
+
+#Allele states counted for sampling, in order (index into ALLELE_CHARS)
+ALLELE_CHARS = np.frombuffer(b"ACGTN-", dtype=np.uint8)
+STATE_N = 4
+STATE_GAP = 5
+
+#Function takes a (samples x sites) mask matrix with rows sorted by population, and the
+#number of samples in each population, and returns a (pops x 6 x sites) array of allele counts
+#States are A, C, G, T, N, gap, with genotypes expanded as in get_iupac_caseless_diploid
+#(homozygotes, N and gaps count twice; ambiguity codes count once per base), looked up in
+#DIPLOID_TABLE one population and state at a time, so temporaries are one byte per genotype
+#of one population
+def countAlleles(masks, sizes):
+	ret = np.empty((len(sizes), 6, masks.shape[1]), dtype=np.int32)
+	dtype = countDtype(sizes)
+	start = 0
+	for k, size in enumerate(sizes):
+		popMasks = masks[start:start+size]
+		for state in range(6):
+			ret[k,state] = np.add.reduce(MASK_DIPLOID[:,state][popMasks], axis=0, dtype=dtype)
+		start += size
+	return(ret)
+
+#Function returns the smallest unsigned dtype able to hold allele counts for populations
+#of the given sizes (2 alleles per sample)
+def countDtype(sizes):
+	if 2*max(sizes) <= np.iinfo(np.uint16).max:
+		return(np.uint16)
+	return(np.uint32)
+
+#splitmix64 mixing function over arrays of uint64 (wraps on overflow)
+def _splitmix64(x):
+	with np.errstate(over="ignore"):
+		z = x + np.uint64(0x9E3779B97F4A7C15)
+		z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+		z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+		return(z ^ (z >> np.uint64(31)))
+
+#Function returns a stream ID for a population name, stable across runs
+def popStream(pop):
+	return(zlib.crc32(str(pop).encode()))
+
+#Function returns the seed for replicate rep (0-based) of a run with the given seed
+#The first replicate uses the run's seed, so it matches a run without replicates
+def replicateSeed(seed, rep):
+	if rep == 0:
+		return(seed)
+	mixed = _splitmix64(np.array([seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64) ^ _splitmix64(np.array([rep], dtype=np.uint64)))
+	return(int(mixed[0]))
+
+#Function returns uniform [0,1) numbers of shape (draws x sites)
+#Each number depends only on (seed, stream, site, draw), so results are the same however
+#the sites are split into chunks or spread across workers
+def siteUniforms(seed, stream, sites, draws):
+	base = _splitmix64(np.array([seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+	base = _splitmix64(base ^ np.uint64(stream & 0xFFFFFFFFFFFFFFFF))
+	keys = _splitmix64(base ^ np.asarray(sites, dtype=np.uint64))
+	ret = np.empty((draws, len(keys)), dtype=np.float64)
+	for d in range(draws):
+		z = _splitmix64(keys + np.uint64(d))
+		ret[d] = (z >> np.uint64(11)) * (1.0/(1 << 53))
+	return(ret)
+
+#Function returns the number of alleles available for sampling at each site
+#counts = (6 x sites) allele counts for one population (from countAlleles)
+def countSampleable(counts, allowN, allowG):
+	total = counts[0:4].sum(axis=0, dtype=np.int64)
+	if allowN:
+		total += counts[STATE_N]
+	if allowG:
+		total += counts[STATE_GAP]
+	return(total)
+
+#Batched version of sampleAlleles: samples n alleles without replacement at every site
+#counts = (6 x sites) allele counts for one population (from countAlleles)
+#sites = index of each site in the alignment (used to key the random numbers)
+#Returns (n x sites) uint8 array of sampled characters (A, C, G, T, N or -)
+#Raises ValueError if any site has fewer than n valid alleles
+def sampleAlleleCounts(counts, n, allowN, allowG, seed, stream, sites):
+	counts = counts.astype(np.int64)
+	if not allowN:
+		counts[STATE_N] = 0
+	if not allowG:
+		counts[STATE_GAP] = 0
+	total = counts.sum(axis=0)
+	if (total < n).any():
+		raise ValueError("Not enough valid alleles to sample %s alleles at %s sites"%(n, np.count_nonzero(total < n)))
+	uniforms = siteUniforms(seed, stream, sites, n)
+	ret = np.empty((n, counts.shape[1]), dtype=np.uint8)
+	cols = np.arange(counts.shape[1])
+	for d in range(n):
+		pick = np.floor(uniforms[d] * total).astype(np.int64)
+		state = np.argmax(np.cumsum(counts, axis=0) > pick, axis=0)
+		ret[d] = ALLELE_CHARS[state]
+		counts[state, cols] -= 1
+		total -= 1
+	return(ret)
+
 #function to sample non-N alleles without replacement
 def sampleAlleles(geno, n, allowN, allowG):
 	expanded = list()
@@ -41,32 +352,111 @@ def sampleList(stuff, r):
 		yield stuff[n-pop-1]
 
 
+#Function to convert a column of nucleotides to a uint8 array of ASCII codes
+#Accepts a list of characters, str, bytes/bytearray, or a uint8 array (returned as is)
+def asCodes(nucs):
+	if isinstance(nucs, np.ndarray):
+		return(nucs)
+	if isinstance(nucs, (bytes, bytearray, memoryview)):
+		return(np.frombuffer(nucs, dtype=np.uint8))
+	if not isinstance(nucs, str):
+		nucs = "".join(nucs)
+	return(np.frombuffer(nucs.encode(), dtype=np.uint8))
+
+#Function returns the OR of the alleles in a column of ASCII codes, ignoring gaps and Ns
+#Raises ValueError for invalid characters
+def _columnUnion(codes):
+	masks = MASK_TABLE[codes]
+	if (masks == MASK_INVALID).any():
+		bad = sorted(set(chr(c) for c in np.unique(codes[masks == MASK_INVALID])))
+		raise ValueError("Invalid character(s) in column: %s"%", ".join(bad))
+	return(np.bitwise_or.reduce(masks[masks != MASK_N], initial=0))
+
+#Byte-oriented checkNGcontent: Returns TRUE if N+gap content of a column is too high
+#(or only N content, if keepG)
+def checkNGcontentBytes(nucs, threshold, keepG=False):
+	classes = CLASS_TABLE[asCodes(nucs)]
+	if keepG:
+		missing = np.count_nonzero(classes == CLASS_N)
+	else:
+		missing = np.count_nonzero((classes == CLASS_N) | (classes == CLASS_GAP))
+	return(tooMissing(missing, len(classes), threshold))
+
+#Byte-oriented isMonomorphic: column of ASCII codes -> True if one base (ignoring gaps and Ns)
+def isMonomorphicBytes(nucs):
+	return(POPCOUNT[_columnUnion(asCodes(nucs))] == 1)
+
+#Byte-oriented isBiallelic: column of ASCII codes -> True if two bases (ignoring gaps and Ns)
+def isBiallelicBytes(nucs):
+	return(POPCOUNT[_columnUnion(asCodes(nucs))] == 2)
+
+#ASCII codes for the numeric output format
+NUMERIC_MAJOR = ord("0")
+NUMERIC_MINOR = ord("1")
+NUMERIC_MISSING = ord("?")
+NUMERIC_GAP = ord("-")
+
+#Bases in the order used to break ties between equally common alleles in nucs2numeric
+_MAJOR_ORDER = np.array([MASK_A, MASK_G, MASK_C, MASK_T], dtype=np.uint8)
+
+#Byte-oriented nucs2numeric: column of ASCII codes -> uint8 array of ASCII 0, 1, ? and -
+#Returns None if the column is neither biallelic nor monomorphic
+def nucs2numericBytes(nucs):
+	codes = asCodes(nucs)
+	union = _columnUnion(codes)
+	nbases = POPCOUNT[union]
+	if nbases == 1:
+		return(np.full(len(codes), NUMERIC_MAJOR, dtype=np.uint8))
+	elif nbases != 2:
+		return(None)
+	masks = MASK_TABLE[codes]
+	counts = np.array([np.count_nonzero(masks == bit) for bit in _MAJOR_ORDER])
+	order = np.argsort(-counts, kind="stable")
+	ret = np.full(len(codes), NUMERIC_MISSING, dtype=np.uint8)
+	ret[masks == MASK_GAP] = NUMERIC_GAP
+	ret[masks == _MAJOR_ORDER[order[0]]] = NUMERIC_MAJOR
+	ret[masks == _MAJOR_ORDER[order[1]]] = NUMERIC_MINOR
+	return(ret)
+
+#Vectorized nucs2numeric over a (samples x sites) uint8 character matrix, in one pass:
+#per site, finds the allele union, the major and minor alleles (ties broken as nucs2numeric
+#does) and encodes every sample as ASCII 0, 1, ? and -. Monomorphic sites are all 0, and
+#are removed unless allowM; sites with no bases at all are only ? and -
+#Returns ((samples x kept sites) encoded matrix, boolean array of kept sites)
+#Raises ValueError for invalid characters, or sites with more than two bases
+def encodeNumeric(chars, allowM=False):
+	masks = nucMasks(chars)
+	nbases = POPCOUNT[alleleUnion(masks)]
+	keep = np.ones(masks.shape[1], dtype=bool) if allowM else (nbases != 1)
+	if (nbases[keep] > 2).any():
+		raise ValueError("Sampled alleles are not biallelic at %s sites"%np.count_nonzero(nbases[keep] > 2))
+	masks = masks[:,keep]
+	nbases = nbases[keep]
+	counts = np.stack([np.count_nonzero(masks == bit, axis=0) for bit in _MAJOR_ORDER])
+	cols = np.arange(masks.shape[1])
+	major = np.argmax(counts, axis=0)
+	counts[major, cols] = -1
+	minor = np.argmax(counts, axis=0)
+	ret = np.full(masks.shape, NUMERIC_MISSING, dtype=np.uint8)
+	ret[masks == MASK_GAP] = NUMERIC_GAP
+	ret[masks == _MAJOR_ORDER[major]] = NUMERIC_MAJOR
+	ret[masks == _MAJOR_ORDER[minor]] = NUMERIC_MINOR
+	ret[:, nbases == 1] = NUMERIC_MAJOR
+	return(ret, keep)
+
 #function to check if N content in list of diploid genotypes (1 element = 1 pair of alleles)
 #is greater than a given threshold
 #Returns TRUE if N+gap content is too high
 #this version treats Ns and gaps as the same
 def checkNGcontent(nucs, threshold):
-	nucs = [x.upper() for x in nucs]
-	twoN = len(nucs)*2
-	Ncontent = ((nucs.count("N")*2) + (nucs.count("-")*2))
-	#print("Ncontent is: ",float(Ncontent/twoN), ":", nucs)
-	if float(Ncontent/twoN) >= float(threshold):
-		return True
-	else:
-		return False
+	return(bool(checkNGcontentBytes(nucs, threshold)))
 
 #function to check if N content in list of diploid genotypes (1 element = 1 pair of alleles)
 #is greater than a given threshold
 #Returns TRUE if N+gap content is too high
 #this version only counts N content
 def checkNcontent(nucs, threshold):
-	nucs = [nucs.upper() for x in nucs]
-	twoN = len(nucs)*2
-	Ncontent = (nucs.count("N")*2)
-	if float(Ncontent/twoN) >= float(threshold):
-		return True
-	else:
-		return False
+	return(bool(checkNGcontentBytes(nucs, threshold, keepG=True)))
 
 #Function takes biallelic list of nucleotides and converts to numeric
 #0 = major allele
@@ -74,150 +464,34 @@ def checkNcontent(nucs, threshold):
 #2 = het
 #? = - or N
 def nucs2numeric(nucs):
-	ret = list()
-	counts = {"A":0, "G":0, "C":0, "T":0}
-	#find major allele
-	for nuc in nucs:
-		nuc = nuc.upper()
-		if nuc not in ("-", "N", "n"):
-			counts[nuc]+=1
-
-	if isBiallelic(nucs):
-		#print(nucs)
-		#sort dict, to list of tuples (b/c dicts are orderless, can't keep as dict)
-		sorted_x = sorted(counts.items(), key=operator.itemgetter(1), reverse=True)
-		majA = sorted_x[0][0]
-		minA = sorted_x[1][0]
-		#print(majA, minA, het)
-
-		for nuc in nucs:
-			nuc = nuc.upper()
-			if nuc == majA:
-				ret.append("0")
-			elif nuc == minA:
-				ret.append("1")
-			elif nuc == "-":
-				ret.append("-")
-			else:
-				ret.append("?")
-
-		return(ret)
-	elif isMonomorphic(nucs):
-		for nuc in nucs:
-			ret.append("0")
-		return(ret)
-	else:
+	ret = nucs2numericBytes(nucs)
+	if ret is None:
 		return(None)
+	return(list(ret.tobytes().decode()))
 
 
 #Function to translate a string of bases to an iupac ambiguity code
 def reverse_iupac(char):
-	char = char.upper()
-	iupac = {
-		'A':'A',
-		'N':'N',
-		'-':'-',
-		'C':'C',
-		'G':'G',
-		'T':'T',
-		'AG':'R',
-		'CT':'Y',
-		'AC':'M',
-		'GT':'K',
-		'AT':'W',
-		'CG':'S',
-		'CGT':'B',
-		'AGT':'D',
-		'ACT':'H',
-		'ACG':'V',
-		'ACGT':'N'
-	}
-	return iupac[char]
+	return(_REVERSE_IUPAC[char])
 
 #Function takes a list of nucleotides, and returns True if the column is monomorphic
 #ignores gaps and Ns
-#expands uipac codes using a call to external function
 def isMonomorphic(nucs):
-	expanded = list()
-	for nuc in nucs:
-		if nuc not in ("-", "N"):
-			for exp in get_iupac_caseless(nuc):
-				expanded.append(exp)
-	uniq_sort = sorted(set(expanded))
-	if len(uniq_sort) != 1:
-		#print(nucs)
-		#print(uniq_sort, len(uniq_sort))
-		return(False)
-	else:
-		return(True)
+	return(bool(isMonomorphicBytes(nucs)))
 
 
 #Function takes a list of nucleotides, and returns True if the column is biallelic
 #ignores gaps and Ns
-#expands uipac codes using a call to external function
 def isBiallelic(nucs):
-	expanded = list()
-	for nuc in nucs:
-		if nuc not in ("-", "N"):
-			for exp in get_iupac_caseless(nuc):
-				expanded.append(exp)
-	uniq_sort = sorted(set(expanded))
-	if len(uniq_sort) != 2:
-		#print(nucs)
-		#print(uniq_sort, len(uniq_sort))
-		return(False)
-	else:
-		return(True)
+	return(bool(isBiallelicBytes(nucs)))
 
 #Function to split character to IUPAC codes, assuing diploidy
 def get_iupac_caseless(char):
-	if char.islower():
-		char = char.upper()
-	iupac = {
-		"A"	: ["A"],
-		"G"	: ["G"],
-		"C"	: ["C"],
-		"T"	: ["T"],
-		"N"	: ["A", "C", "G", "T"],
-		"-"	: ["-"],
-		"R"	: ["A","G"],
-		"Y"	: ["C","T"],
-		"S"	: ["G","C"],
-		"W"	: ["A","T"],
-		"K"	: ["G","T"],
-		"M"	: ["A","C"],
-		"B"	: ["C","G","T"],
-		"D"	: ["A","G","T"],
-		"H"	: ["A","C","T"],
-		"V"	: ["A","C","G"]
-	}
-	ret = iupac[char]
-	return ret
+	return(_IUPAC[char])
 
 #Function to split character to IUPAC codes, returning diploid genotype
 def get_iupac_caseless_diploid(char):
-	if char.islower():
-		char = char.upper()
-	iupac = {
-		"A"	: ["A", "A"],
-		"G"	: ["G", "G"],
-		"C"	: ["C", "C"],
-		"T"	: ["T", "T"],
-		"N"	: ["N", "N"],
-		"-"	: ["-","-"],
-		"R"	: ["A","G"],
-		"Y"	: ["C","T"],
-		"S"	: ["G","C"],
-		"W"	: ["A","T"],
-		"K"	: ["G","T"],
-		"M"	: ["A","C"],
-		"B"	: ["C","G","T"],
-		"D"	: ["A","G","T"],
-		"H"	: ["A","C","T"],
-		"V"	: ["A","C","G"]
-	}
-	ret = iupac[char]
-	return ret
+	return(_IUPAC_DIPLOID[char])
 
 #Goes through a dict of sequences and get the alignment length
 def getSeqLen(aln):
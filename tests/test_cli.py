@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+"""Command-line checks for sampleBiMarkers.py, run on a small generated alignment
+Run with: python -m unittest discover tests (or python -m pytest tests)"""
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sampleBiMarkers.py")
+
+#Rows of the test alignment: two populations of three samples, with biallelic columns
+SEQS = [
+	("a1", "ACGTACGTAC"*4),
+	("a2", "ACGTACGTAC"*4),
+	("a3", "GCGTATGTAC"*4),
+	("b1", "GTGAACCTAC"*4),
+	("b2", "GTGAACCTAG"*4),
+	("b3", "ATGAACCTAG"*4)
+]
+
+class TestOutputErrors(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix="sbm_test_")
+		self.phy = os.path.join(self.dir, "t.phy")
+		self.pop = os.path.join(self.dir, "t.pop")
+		with open(self.phy, "w") as fh:
+			fh.write("%s %s\n"%(len(SEQS), len(SEQS[0][1])))
+			for name, seq in SEQS:
+				fh.write(name + " " + seq + "\n")
+		with open(self.pop, "w") as fh:
+			for name, seq in SEQS:
+				fh.write(name + "\t" + name[0] + "\n")
+		self.missing = os.path.join(self.dir, "no_such_dir", "out.nex")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	#Runs sampleBiMarkers.py; returns the CompletedProcess (fails the test if it hangs)
+	def run_cli(self, *args):
+		try:
+			return(subprocess.run([sys.executable, SCRIPT, "-i", self.phy, "-p", self.pop, "--seed", "1"] + list(args),
+				stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120))
+		except subprocess.TimeoutExpired:
+			self.fail("sampleBiMarkers.py did not terminate")
+
+	def test_writes_output(self):
+		out = os.path.join(self.dir, "out.nex")
+		ret = self.run_cli("-o", out)
+		self.assertEqual(ret.returncode, 0, ret.stdout.decode())
+		self.assertTrue(os.path.exists(out))
+
+	def test_unwritable_output(self):
+		ret = self.run_cli("-o", self.missing)
+		self.assertNotEqual(ret.returncode, 0)
+		self.assertIn(b"Could not write output", ret.stdout)
+
+	def test_unwritable_replicates(self):
+		ret = self.run_cli("-s", "2", "--replicates", "2", "-o", self.missing)
+		self.assertNotEqual(ret.returncode, 0)
+		self.assertIn(b"Could not write output", ret.stdout)
+
+	def test_unwritable_batch(self):
+		manifest = os.path.join(self.dir, "batch.tsv")
+		with open(manifest, "w") as fh:
+			fh.write("out\tsample\n")
+			fh.write(os.path.join(self.dir, "ok.nex") + "\t1\n")
+			fh.write(self.missing + "\t2\n")
+		ret = self.run_cli("--batch", manifest)
+		self.assertNotEqual(ret.returncode, 0)
+		self.assertIn(b"Could not write output", ret.stdout)
+
+	def test_empty_selection(self):
+		ret = self.run_cli("-I", "x", "-o", os.path.join(self.dir, "out.nex"))
+		self.assertNotEqual(ret.returncode, 0)
+		self.assertIn(b"No populations remaining", ret.stdout)
+		self.assertNotIn(b"Indexing", ret.stdout)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+import re
+import os
+import numpy as np
+import aln_file_tools
+import seq_tools
+
+"""Functions for streaming biallelic SNPs out of a VCF file
+Genotypes (GT) are read straight into per-population allele counts, in the same
+(pops x 6 x sites) layout as seq_tools.countAlleles, so no IUPAC expansion is needed"""
+
+TAB = ord("\t")
+COLON = ord(":")
+ZERO = ord("0")
+ONE = ord("1")
+DOT = ord(".")
+
+#Index of each base in the allele count states (A, C, G, T, N, gap)
+BASE_STATE = {"A":0, "C":1, "G":2, "T":3}
+
+#Object for streaming records from a (plain, gzip or BGZF) VCF file
+#names = sample names from the #CHROM line; index = sample name -> column
+#nrecords = number of data records read so far; nsnps = how many of those were biallelic SNPs
+class VcfReader():
+	def __init__(self, path, threads=None):
+		if not os.path.exists(path):
+			raise FileNotFoundError("File %s not found!"%path)
+		self.path = path
+		self.fh = aln_file_tools.openInput(path, threads)
+		self.names = list()
+		self.index = dict()
+		self.nrecords = 0
+		self.nsnps = 0
+		for line in self.fh:
+			if line.startswith("##"):
+				continue
+			if line.startswith("#CHROM"):
+				self.names = line.rstrip("\r\n").split("\t")[9:]
+				break
+			raise ValueError("VCF file %s has no #CHROM header line."%path)
+		for i, name in enumerate(self.names):
+			self.index[name] = i
+
+	def __len__(self):
+		return(len(self.names))
+
+	def __contains__(self, name):
+		return(name in self.index)
+
+	#Generator yielding blocks of up to block biallelic SNP records as
+	#(record index of each site, (pops x 6 x sites) allele counts, (pops x sites) missing counts)
+	#rows = sample columns sorted by population; sizes = number of samples in each population
+	def iterBlocks(self, rows, sizes, block=65536):
+		for sites, refs, alts, dosage in self.iterGenotypes(rows, block):
+			counts, popMissing = genotypeCounts(dosage, refs, alts, sizes)
+			yield(sites, counts, popMissing)
+
+	#Generator yielding blocks of up to block biallelic SNP records as
+	#(record index of each site, REF state, ALT state, (rows x sites) ALT dosage, -1 = missing)
+	#Records whose REF and ALT are not single bases (A/C/G/T) are skipped, but still counted
+	#in the record index (which keys the random numbers used for sampling)
+	def iterGenotypes(self, rows, block=65536):
+		rows = np.asarray(rows, dtype=np.intp)
+		sites = list()
+		refs = list()
+		alts = list()
+		genos = list()
+		for line in self.fh:
+			if not line.strip() or line[0] == "#":
+				continue
+			record = self.nrecords
+			self.nrecords += 1
+			fields = line.rstrip("\r\n").split("\t", 9)
+			ref = fields[3].upper()
+			alt = fields[4].upper()
+			if ref not in BASE_STATE or alt not in BASE_STATE:
+				continue
+			if len(fields) < 10:
+				raise ValueError("VCF record %s:%s has no genotype columns."%(fields[0], fields[1]))
+			genos.append(parseGenotypes(fields[8], fields[9], len(self.names))[rows])
+			sites.append(record)
+			self.nsnps += 1
+			refs.append(BASE_STATE[ref])
+			alts.append(BASE_STATE[alt])
+			if len(sites) >= block:
+				yield(self._block(sites, refs, alts, genos))
+				sites, refs, alts, genos = list(), list(), list(), list()
+		if sites:
+			yield(self._block(sites, refs, alts, genos))
+
+	def _block(self, sites, refs, alts, genos):
+		return(np.array(sites, dtype=np.int64), np.array(refs, dtype=np.intp), np.array(alts, dtype=np.intp),
+			np.array(genos, dtype=np.int8).T)
+
+	def close(self):
+		self.fh.close()
+
+#Function converts a block of ALT dosages into allele and missing counts
+#dosage = (samples x sites) ALT dosage (-1 = missing) with rows sorted by population
+#refs, alts = REF and ALT state (0-3 = A, C, G, T) of each site
+#Returns ((pops x 6 x sites) allele counts, (pops x sites) missing genotype counts)
+def genotypeCounts(dosage, refs, alts, sizes):
+	starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.intp)
+	missing = (dosage < 0)
+	altCount = np.add.reduceat(np.where(missing, 0, dosage).astype(np.int32), starts, axis=0)
+	popMissing = np.add.reduceat(missing.astype(np.int32), starts, axis=0)
+	refCount = 2*(np.asarray(sizes, dtype=np.int32)[:,None] - popMissing) - altCount
+	cols = np.arange(dosage.shape[1])
+	counts = np.zeros((len(sizes), 6, dosage.shape[1]), dtype=np.int32)
+	counts[:, refs, cols] = refCount
+	counts[:, alts, cols] = altCount
+	counts[:, seq_tools.STATE_N, :] = 2*popMissing
+	return(counts, popMissing)
+
+#Function to read the GT of every sample in a VCF record as ALT allele dosage (0, 1, 2)
+#Missing genotypes (any allele ".") are -1; haploid calls count as homozygous
+#Diploid single-digit calls with GT first in FORMAT (the usual case) are parsed with NumPy;
+#anything else falls back to splitting each sample field
+def parseGenotypes(fmt, samples, nsamples):
+	if fmt.startswith("GT"):
+		ret = _parseGenotypesFast(samples, nsamples)
+		if ret is not None:
+			return(ret)
+	keys = fmt.split(":")
+	if "GT" not in keys:
+		raise ValueError("VCF record has no GT field (FORMAT %s)."%fmt)
+	gt = keys.index("GT")
+	ret = np.empty(nsamples, dtype=np.int8)
+	fields = samples.split("\t")
+	if len(fields) != nsamples:
+		raise ValueError("VCF record has %s genotype columns (expected %s)."%(len(fields), nsamples))
+	for i, field in enumerate(fields):
+		parts = field.split(":")
+		alleles = re.split(r"[/|]", parts[gt]) if gt < len(parts) else ["."]
+		if "." in alleles or len(alleles) > 2:
+			ret[i] = -1
+		elif len(alleles) == 1:
+			ret[i] = 2*int(alleles[0] == "1")
+		else:
+			ret[i] = int(alleles[0] == "1") + int(alleles[1] == "1")
+	return(ret)
+
+#Vectorized parse of diploid, single-digit GT calls at the start of each sample field
+#Returns None if any field doesn't look like that
+def _parseGenotypesFast(samples, nsamples):
+	arr = np.frombuffer(samples.encode() + b"\t\t\t\t", dtype=np.uint8)
+	starts = np.concatenate(([0], np.flatnonzero(arr[:-4] == TAB)+1))
+	if len(starts) != nsamples:
+		raise ValueError("VCF record has %s genotype columns (expected %s)."%(len(starts), nsamples))
+	first = arr[starts]
+	second = arr[starts+2]
+	after = arr[starts+3]
+	sep = arr[starts+1]
+	ok = ((sep == ord("/")) | (sep == ord("|"))) & ((after == COLON) | (after == TAB))
+	ok &= ((first == ZERO) | (first == ONE) | (first == DOT)) & ((second == ZERO) | (second == ONE) | (second == DOT))
+	if not ok.all():
+		return(None)
+	ret = (first == ONE).astype(np.int8) + (second == ONE).astype(np.int8)
+	ret[(first == DOT) | (second == DOT)] = -1
+	return(ret)